@@ -0,0 +1,196 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+import logging
+from StreamHub import parse_stream_options
+
+
+def start_async_http_server(pipeline, frame_source, address, port, hub, latency=None):
+    '''
+    Runs the asyncio version of the http server. Serves the same /cam.html and /<name>.mjpg routes as
+    GenericHTTPServer, but every viewer is a coroutine on a single event loop instead of its own OS thread.
+    This function should be used as the target for a thread so that the event loop doesn't stall the main thread.
+    @params
+    pipeline -- pipeline object as specified by GenericPipeline
+    frame_source -- image Source object that contains a function: get_frame() that returns an image or None
+    address -- str (ie. 'localhost', '10.1.92.94')
+    port -- int
+    hub -- StreamHub that the pipeline's output frames are published to
+    latency -- LatencyStats served as /latency.json, None for none
+    '''
+    server = AsyncCamServer(pipeline, address, port, hub, latency=latency)
+    asyncio.run(server.serve_forever())
+
+
+class AsyncCamServer:
+
+    def __init__(self, pipeline, address, port, hub, client_queue_size=1, write_timeout=5.0, latency=None):
+        '''
+        client_queue_size -- frames buffered per client. When a slow client's queue is full, its oldest frame is dropped.
+        write_timeout -- seconds a client may block a write before it is disconnected
+        latency -- LatencyStats served as /latency.json, None for none
+        '''
+        self.pipeline = pipeline
+        self.address = address
+        self.port = port
+        self.hub = hub
+        self.latency = latency
+
+        self.client_queue_size = client_queue_size
+        self.write_timeout = write_timeout
+
+        self.loop = None
+        self.clients = {}  # stream name -> dict of client frame queue -> (width, quality) the client wants
+        self.new_frame_events = {}  # stream name -> asyncio.Event set when the hub has a new frame
+        self.pump_tasks = {}  # stream name -> task feeding that stream's clients
+
+    def url(self, path):
+        return 'http://' + str(self.address) + ':' + str(self.port) + '/' + path
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, self.address, self.port)
+        logging.info('async server started at http://%s:%s/cam.html', self.address, self.port)
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        try:
+            # Only the request line matters, the rest of the headers are read and ignored
+            request = await reader.readuntil(b'\r\n\r\n')
+            url = urlsplit(request.split(b'\r\n', 1)[0].split(b' ')[1].decode('UTF-8'))
+            path = url.path
+
+            # Split up HTTP URL so we know which page was requested (eg. "cam" of cam.mjpg?w=160&q=40)
+            arg = path.split('/')[-1].rsplit('.', 1)[0]
+
+            if path.endswith('.mjpg') and arg in self.get_stream_names():
+                await self.stream(arg, writer, *parse_stream_options(url.query))
+            elif path.endswith('.html') and arg == 'cam':
+                await self.send_page(writer)
+            elif path.endswith('/latency.json') and self.latency is not None:
+                await self.send_latency(writer)
+            else:
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+                await writer.drain()
+
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, IndexError, UnicodeDecodeError):
+            pass  # malformed request or client went away before sending one
+        except (ConnectionError, asyncio.TimeoutError):
+            pass  # client went away or stopped reading
+        finally:
+            writer.close()
+
+    def get_stream_names(self):
+        # The pipeline's output frames, and the camera itself if it's streamed without re-encoding
+        return self.pipeline.get_snapshot().get_output_names() + self.hub.get_jpeg_names()
+
+    async def send_page(self, writer):
+        # Overall webpage that serves images
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-type: text/html\r\nCache-Control: no-store\r\n\r\n')
+        writer.write('<html><head></head><body>'.encode('UTF-8'))
+
+        for name in self.get_stream_names():
+            writer.write(('<img style="margin-right: 20px;" src="' + self.url(name + '.mjpg"') + '/>').encode('UTF-8'))
+
+        writer.write('</body></html>'.encode('UTF-8'))
+        await writer.drain()
+
+    async def send_latency(self, writer):
+        # Rolling latency percentiles of every pipeline stage and end to end, see LatencyStats
+        body = json.dumps(self.latency.get_percentiles()).encode('UTF-8')
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-type: application/json\r\nCache-Control: no-store\r\n\r\n')
+        writer.write(body)
+        await writer.drain()
+
+    async def stream(self, name, writer, width=None, quality=None, fps=None):
+        '''
+        width, quality -- of the frames for this client (see FrameStream.wait_for_jpeg()), None for the defaults
+        fps -- max frames per second sent to this client, None for every new frame
+        '''
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-type: multipart/x-mixed-replace; boundary=--jpgboundary\r\n\r\n')
+
+        queue = asyncio.Queue(maxsize=self.client_queue_size)
+        self.add_client(name, queue, width, quality)
+
+        next_time = time.monotonic()
+        try:
+            while True:
+                # Stay under this client's FPS, the queue keeps only the newest frames meanwhile
+                remaining = next_time - time.monotonic()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+
+                img_str = await queue.get()
+
+                writer.write(b'Content-type: image/jpeg\r\nContent-length: ' + str(len(img_str)).encode('UTF-8')
+                             + b'\r\nCache-Control: no-store\r\n\r\n')
+                writer.write(img_str)
+                writer.write(b'\r\n--jpgboundary\r\n')
+
+                # Only this client waits on its own socket; the pump keeps dropping frames for it meanwhile
+                await asyncio.wait_for(writer.drain(), self.write_timeout)
+
+                self.hub.add_sent(len(img_str))
+                if fps is not None:
+                    next_time = max(next_time, time.monotonic() - 1.0 / fps) + 1.0 / fps
+        finally:
+            self.clients[name].pop(queue, None)
+            self.hub.unsubscribe(name)
+
+    def add_client(self, name, queue, width=None, quality=None):
+        if name not in self.clients:
+            self.clients[name] = {}
+            self.new_frame_events[name] = asyncio.Event()
+
+            # Called from the pipeline thread, so hop over to the event loop
+            event = self.new_frame_events[name]
+            self.hub.get_stream(name).add_listener(lambda: self.loop.call_soon_threadsafe(event.set))
+
+        self.clients[name][queue] = (width, quality)
+        self.hub.subscribe(name)  # the pipeline only renders this stream's frames while someone is subscribed
+
+        if name not in self.pump_tasks or self.pump_tasks[name].done():
+            self.pump_tasks[name] = asyncio.ensure_future(self.pump(name))
+            self.pump_tasks[name].add_done_callback(self.pump_done)
+        else:
+            self.new_frame_events[name].set()  # send the current frame right away if this client wants a new variant
+
+    async def pump(self, name):
+        '''Feeds every new frame of a stream to that stream's client queues. Stops once the stream has no clients.'''
+        seqs = {}  # (width, quality) -> seq of the last frame sent to the clients that want that variant
+        event = self.new_frame_events[name]
+        event.set()  # send the current frame to new clients right away
+
+        while self.clients[name]:
+            await event.wait()
+            event.clear()
+
+            for variant in set(self.clients[name].values()):
+                # Encoding happens off the event loop, once per frame and variant no matter how many clients there are
+                try:
+                    seq, img_str = await self.loop.run_in_executor(None, self.hub.wait_for_jpeg, name,
+                                                                   seqs.get(variant, 0), 0, *variant)
+                except Exception:
+                    # Skip this frame but keep pumping, the clients of this stream would wait forever otherwise
+                    logging.exception('Could not encode a frame of %s', name)
+                    continue
+                if img_str is None:
+                    continue
+                seqs[variant] = seq
+
+                for queue, client_variant in list(self.clients[name].items()):
+                    if client_variant != variant:
+                        continue
+
+                    # Drop the oldest frame for clients that haven't kept up
+                    if queue.full():
+                        queue.get_nowait()
+                    queue.put_nowait(img_str)
+
+    def pump_done(self, task):
+        # Log whatever still ended a pump, instead of asyncio only mentioning it when the task is garbage collected
+        if not task.cancelled() and task.exception() is not None:
+            logging.error('Stream pump stopped', exc_info=task.exception())
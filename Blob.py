@@ -1,11 +1,19 @@
 import cv2
 import numpy as np
+from Threshold import HSVThreshold
+from BufferPool import BufferPool
+import Utility
 
 
 class BlobDetector:
 
-    def __init__(self, hsv_lower, hsv_upper, hsv_lower2=None, hsv_upper2=None):
+    def __init__(self, hsv_lower, hsv_upper, hsv_lower2=None, hsv_upper2=None, use_lut=False, blur_mode='gaussian',
+                 pool=None):
+        # Counts the frame-sized allocations (see BufferPool), shared with the pipeline if given
+        self.pool = BufferPool('blob') if pool is None else pool
+
         # Vision constants
+        self.blur_mode = blur_mode  # see Utility.blur
         self.blur_radius = 6
         self.ksize_blur = int(6 * round(self.blur_radius) + 1)
         self.min_area = 20
@@ -14,14 +22,17 @@ class BlobDetector:
         self.hsv_lower = hsv_lower
         self.hsv_upper = hsv_upper
 
-        self.hsv_lower2 = None
-        self.hsv_upper2 = None
+        self.hsv_lower2 = hsv_lower2
+        self.hsv_upper2 = hsv_upper2
+
+        # Second range is for colors that wrap around the hue axis (ie. red)
+        ranges = [(self.hsv_lower, self.hsv_upper)]
+        if self.hsv_lower2 is not None and self.hsv_upper2 is not None:
+            ranges.append((self.hsv_lower2, self.hsv_upper2))
+        self.threshold = HSVThreshold(ranges, use_lut, self.pool)
 
-        # Pre-allocated numpy arrays
+        # Pre-allocated numpy arrays (reused through dst= as long as the frame size stays the same)
         self.blur_frame = None
-        self.hsv_frame = None
-        self.mask1 = None
-        self.mask2 = None
         self.mask = None
         self.canny_frame = None
         self.binary_frame = None
@@ -29,29 +40,41 @@ class BlobDetector:
 
 
     def process(self, frame):
-        output_value = 0
+        # Blur (the pyramid blur downsamples into a frame from the pool)
+        small = self.pool.acquire(Utility.get_pyramid_shape(frame.shape)) if self.blur_mode == 'pyramid' else None
+        self.blur_frame = self.pool.reuse(Utility.blur(frame, round(self.blur_radius), self.ksize_blur, self.blur_mode,
+                                                       self.blur_frame, small), self.blur_frame)
+        self.pool.release(small)
 
-        # Blur
-        self.blur_frame = cv2.GaussianBlur(frame, (self.ksize_blur, self.ksize_blur), round(self.blur_radius))
+        output_value = self.process_blurred(frame, self.blur_frame)
+        self.pool.end_frame()
 
-        # Convert to HSV
-        self.hsv_frame = cv2.cvtColor(self.blur_frame, cv2.COLOR_BGR2HSV)
+        return output_value
 
-        # Color mask
-        self.mask1 = cv2.inRange(self.hsv_frame, self.hsv_lower, self.hsv_upper)
+    # Same as process(), but with the blur (and optionally the HSV conversion) already done, so several detectors can
+    # share them
+    def process_blurred(self, frame, blur_frame, hsv_frame=None):
+        circles = self.detect_blurred(frame.shape, blur_frame, hsv_frame)
 
-        if self.hsv_lower2 is not None and self.hsv_upper2 is not None:
-            self.mask2 = cv2.inRange(self.hsv_frame, self.hsv_lower2, self.hsv_upper2)
-            self.mask = cv2.bitwise_or(self.mask1, self.mask2)
+        self.draw_circles(frame, circles)
+
+        # Return data
+        return 0 if circles is None else len(circles)
+
+    # Finds the circles without drawing anything, returns them (as from cv2.HoughCircles) or None
+    def detect_blurred(self, frame_shape, blur_frame, hsv_frame=None):
+        # Color mask
+        if hsv_frame is not None:
+            self.mask = self.threshold.apply_hsv(hsv_frame, self.mask)
         else:
-            self.mask = self.mask1
+            self.mask = self.threshold.apply(blur_frame, self.mask)
 
         # Canny edge
-        self.canny_frame = cv2.Canny(self.mask, 200, 250)
+        self.canny_frame = self.pool.reuse(cv2.Canny(self.mask, 200, 250, edges=self.canny_frame), self.canny_frame)
 
         # Min and max circle radii
-        w = frame.shape[0]
-        h = frame.shape[1]
+        w = frame_shape[0]
+        h = frame_shape[1]
         min_radius = (int) (w / 12)
         max_radius = (int) (w / 2)
 
@@ -59,21 +82,22 @@ class BlobDetector:
         self.circles = cv2.HoughCircles(self.canny_frame, cv2.HOUGH_GRADIENT, 1, (int) (w / 4), param1=254, param2=25,
                                         minRadius=min_radius, maxRadius=max_radius)
 
-        # Draw circles
         if self.circles is not None:
             self.circles = np.uint16(np.around(self.circles))
-            for i in self.circles[0, :]:
-                center = (i[0], i[1])
-                # circle center
-                cv2.circle(frame, center, 1, (255, 0, 255), 3)
-                # circle outline
-                radius = i[2]
-                cv2.circle(frame, center, radius, (255, 0, 255), 3)
 
-            # Return data
-            output_value = len(self.circles)
+        return self.circles
 
-        return output_value
+    def draw_circles(self, frame, circles):
+        if circles is None:
+            return
+
+        for i in circles[0, :]:
+            center = (i[0], i[1])
+            # circle center
+            cv2.circle(frame, center, 1, (255, 0, 255), 3)
+            # circle outline
+            radius = i[2]
+            cv2.circle(frame, center, radius, (255, 0, 255), 3)
 
     def find_blobs(self, frame):
         params = cv2.SimpleBlobDetector_Params()
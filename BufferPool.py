@@ -0,0 +1,96 @@
+import collections
+import threading
+import logging
+import numpy as np
+
+
+class BufferPool:
+    '''
+    Frame-sized arrays for a pipeline, allocated once and then reused, so the steady state doesn't allocate at all
+    (allocations cause frame time jitter on the Jetson). acquire() hands out a free array of the right shape, or
+    allocates one if there is none, and release() gives it back when nothing uses it anymore. fit() grows a scratch
+    buffer that is kept by its owner instead.
+
+    The pool also counts every frame-sized allocation of its pipeline (including OpenCV outputs that couldn't be
+    written into the given dst, see reuse()), so a regression shows up in get_allocations_per_frame() and in the debug
+    log. Small arrays (ie. contours and blob stats) aren't counted.
+    '''
+
+    def __init__(self, name='pipeline', window=100):
+        '''
+        name -- str used for logging (ie. 'turret')
+        window -- frames the allocations per frame are averaged over, and logged (at debug level) after
+        '''
+        self.name = name
+        self.window = window
+
+        self.free = collections.defaultdict(list)  # (shape, dtype) -> arrays not in use
+        self.lock = threading.Lock()
+
+        self.allocations = 0  # since the start
+        self.frames = 0
+        self.window_allocations = 0  # in the current window
+        self.window_frames = 0
+        self.allocations_per_frame = 0.0  # over the last full window
+
+    def acquire(self, shape, dtype=np.uint8):
+        '''Returns an uninitialized array of this shape and dtype. Give it back with release() when done.'''
+        key = (tuple(shape), np.dtype(dtype).str)
+
+        with self.lock:
+            if self.free[key]:
+                return self.free[key].pop()
+
+        self.count_allocation()
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buffer):
+        if buffer is None:
+            return
+
+        with self.lock:
+            self.free[(buffer.shape, buffer.dtype.str)].append(buffer)
+
+    def fit(self, buffer, shape, dtype=np.uint8):
+        '''
+        Returns buffer if it is at least as large as shape in every dimension, otherwise a new one that is (and at least
+        as large as buffer, so a buffer used for different sizes stops growing). Slice the result down to shape.
+        '''
+        if buffer is not None and buffer.dtype == dtype and buffer.ndim == len(shape):
+            if all(have >= need for have, need in zip(buffer.shape, shape)):
+                return buffer
+            shape = tuple(max(have, need) for have, need in zip(buffer.shape, shape))
+
+        self.count_allocation()
+        return np.empty(shape, dtype=dtype)
+
+    def reuse(self, result, dst):
+        '''Returns result (of an OpenCV call given dst=dst), counting an allocation if it wasn't written into dst'''
+        if result is not dst:
+            self.count_allocation()
+        return result
+
+    def count_allocation(self):
+        with self.lock:
+            self.allocations += 1
+            self.window_allocations += 1
+
+    def end_frame(self):
+        '''Call once per processed frame'''
+        with self.lock:
+            self.frames += 1
+            self.window_frames += 1
+
+            if self.window_frames < self.window:
+                return
+
+            self.allocations_per_frame = self.window_allocations / self.window_frames
+            self.window_allocations = 0
+            self.window_frames = 0
+
+        logging.debug('%s: %.2f allocations per frame (%d total in %d frames)', self.name, self.allocations_per_frame,
+                      self.allocations, self.frames)
+
+    def get_allocations_per_frame(self):
+        '''Average frame-sized allocations per frame over the last window of frames (0 in the steady state)'''
+        return self.allocations_per_frame
@@ -0,0 +1,118 @@
+import glob
+import os
+import random
+import time
+import logging
+import cv2
+import numpy as np
+
+
+class CachedImageSource:
+    '''
+    Image source that serves still images (one file, a whole directory like images_2/, or a list of files) for testing
+    without a camera. Every image is decoded (and resized) once up front, so get_frame() costs a copy instead of a PNG
+    decode and file lookup like StaticImageSource, and the pipelines are what's being measured.
+
+    Frames are copied out of the cache into a ring of reused buffers, so nothing a pipeline does to a frame can change
+    the cached image. A buffer is handed out again after `copies` more frames, so keep that above the number of frames
+    a pipeline can hold on to at once (every stage and queue of a StagedPipeline, plus the snapshots being streamed).
+    '''
+
+    def __init__(self, paths, size=None, fps=None, order='round_robin', copies=12, seed=None):
+        '''
+        paths -- image file, directory, glob pattern (ie. 'images/*.png') or list of those
+        size -- (width, height) to resize every image to, None to keep their own sizes
+        fps -- max frames per second get_frame() returns (it waits for the next one), None for as fast as asked
+        order -- 'round_robin' to go through the images in (sorted) order, 'random' to pick one each time
+        copies -- frames in the ring of copies, 0 to return read-only views of the cache without copying
+        seed -- seed of the random order, to get the same frames every run
+        '''
+        self.fps = fps
+        self.order = order
+        self.random = random.Random(seed)
+
+        self.paths = []  # of the cached images
+        self.images = []
+        for path in find_images(paths):
+            image = cv2.imread(path)
+            if image is None:
+                logging.info('Could not read %s, skipping it', path)
+                continue
+
+            if size is not None and (image.shape[1], image.shape[0]) != tuple(size):
+                image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+            image.flags.writeable = False
+            self.paths.append(path)
+            self.images.append(image)
+
+        if not self.images:
+            raise ValueError('No images found in ' + str(paths))
+        logging.info('Cached %d images for the image source', len(self.images))
+
+        # Pre-allocated frames the cached images are copied into, reused round robin
+        self.buffers = [None] * copies
+        self.buffer_index = 0
+
+        self.index = -1  # of the last image returned
+        self.next_time = None  # time.monotonic() the next frame is due at
+
+        # Metadata of the last frame returned by get_frame()
+        self.frame = None
+        self.frame_timestamp = None
+        self.frame_seq = 0
+
+    def get_frame(self):
+        if self.order == 'random':
+            self.index = self.random.randrange(len(self.images))
+        else:
+            self.index = (self.index + 1) % len(self.images)
+
+        # Stay under the target FPS
+        if self.fps:
+            now = time.monotonic()
+            due_time = now if self.next_time is None else self.next_time
+            if due_time > now:
+                time.sleep(due_time - now)
+            self.next_time = max(due_time, now) + 1.0 / self.fps
+
+        self.frame = self.copy(self.images[self.index])
+        self.frame_timestamp = time.monotonic()
+        self.frame_seq += 1
+        return self.frame
+
+    def copy(self, image):
+        if not self.buffers:
+            return image
+
+        buffer = self.buffers[self.buffer_index]
+        if buffer is None or buffer.shape != image.shape:
+            buffer = self.buffers[self.buffer_index] = np.empty_like(image)
+        self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+
+        np.copyto(buffer, image)
+        return buffer
+
+    def get_frame_info(self):
+        '''Returns (frame, capture timestamp, sequence number) of the last frame returned by get_frame()'''
+        return self.frame, self.frame_timestamp, self.frame_seq
+
+    def get_path(self):
+        '''Returns the file of the last frame returned by get_frame() (ie. to check the output values against)'''
+        return self.paths[self.index] if self.index >= 0 else None
+
+
+def find_images(paths):
+    '''Returns the sorted image files of a file, directory or glob pattern, or of a list of those'''
+    if isinstance(paths, str):
+        paths = [paths]
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(p for p in glob.glob(os.path.join(path, '*'))
+                            if os.path.splitext(p)[1].lower() in ('.png', '.jpg', '.jpeg', '.bmp'))
+        elif glob.has_magic(path):
+            files += sorted(glob.glob(path))
+        else:
+            files.append(path)
+    return files
@@ -0,0 +1,93 @@
+import threading
+import time
+import logging
+
+
+class FrameGrabber:
+    '''
+    Continuously reads frames from a VideoCapture in a background thread so that the vision pipeline never waits on the
+    camera. Only the newest frame is kept (older ones are dropped as new ones come in); get_latest() hands it out.
+
+    open_cap -- function that returns an opened cv2.VideoCapture (called again whenever the cap dies)
+    name -- str used for logging/thread names (ie. 'turret')
+
+    Frames are kept as read() returns them, so when the cap gives out undecoded JPEGs (see Utility.request_mjpeg), only
+    the frames the pipeline takes ever get decoded.
+    '''
+
+    def __init__(self, open_cap, name='camera'):
+        self.open_cap = open_cap
+        self.name = name
+
+        self.cap = None  # VideoCapture object, only touched by the grabber thread
+        self.latest = (None, None, 0)  # (frame, timestamp, seq) of the newest frame
+        self.seq = 0  # sequence number of the newest frame
+
+        self.condition = threading.Condition()
+        self.listeners = []  # functions(frame, timestamp, seq) called from the grabber thread for every frame read
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.name + '-grabber', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    # Used in thread
+    def run(self):
+        while self.running:
+            # If the VideoCapture is not initialized
+            if self.cap is None or (not self.cap.isOpened()):
+                logging.info('Trying to initialize %s cap...', self.name)
+                self.cap = self.open_cap()
+
+                if not self.cap.isOpened():
+                    time.sleep(0.5)
+                    continue
+
+            ret, frame = self.cap.read()
+            timestamp = time.monotonic()
+
+            if not ret or frame is None:
+                # Camera was unplugged or timed out, re-open it on the next pass
+                logging.info('Lost %s cap, re-initializing', self.name)
+                self.cap.release()
+                self.cap = None
+                continue
+
+            with self.condition:
+                self.seq += 1
+                seq = self.seq
+                self.latest = (frame, timestamp, seq)
+                self.condition.notify_all()
+
+            for listener in list(self.listeners):
+                listener(frame, timestamp, seq)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_latest(self, after_seq=0, timeout=None):
+        '''
+        Returns the newest (frame, timestamp, seq). If after_seq is given, waits (up to timeout seconds) for a
+        frame newer than after_seq. Returns (None, None, after_seq) if no such frame arrives in time.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > after_seq, timeout):
+                return None, None, after_seq
+
+            return self.latest
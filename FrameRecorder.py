@@ -0,0 +1,184 @@
+import atexit
+import queue
+import struct
+import threading
+import time
+import logging
+import cv2
+import numpy as np
+
+# Recording file layout (little endian), made to be read back with np.memmap without copying (see ReplaySource):
+#   64 byte file header: magic, version, frame height, width, channels (0 for single channel frames)
+#   then one record per frame: 64 byte record header (frame seq, capture timestamp), then the raw frame bytes, padded so
+#   every record (and so every frame) starts 64 byte aligned
+MAGIC = b'GVREC\0\0\0'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sIIII')
+RECORD_HEADER = struct.Struct('<qd')
+ALIGN = 64
+
+
+def get_record_dtype(shape):
+    '''Returns the NumPy dtype of one record of frames of this shape'''
+    frame_bytes = int(np.prod(shape))
+    padding = -frame_bytes % ALIGN
+    fields = [('seq', '<i8'), ('timestamp', '<f8'), ('header_padding', 'V' + str(ALIGN - RECORD_HEADER.size)),
+              ('frame', np.uint8, tuple(shape))]
+    if padding:
+        fields.append(('frame_padding', 'V' + str(padding)))
+    return np.dtype(fields)
+
+
+class FrameRecorder:
+    '''
+    Appends raw camera frames with their capture timestamps to a recording file from a background writer thread, as a
+    black box of what a camera saw and to replay it later (see ReplaySource).
+
+    record() only puts the frame on a bounded queue, so the pipeline never waits on the disk: when the writer falls
+    behind, frames are dropped (and counted) instead. Every record is written straight to the OS, so a crash only loses
+    the frames still in the queue.
+    '''
+
+    def __init__(self, path, max_queue=8, max_bytes=None, name='recorder'):
+        '''
+        path -- file to record to, overwritten if it exists
+        max_queue -- frames waiting to be written before new ones are dropped
+        max_bytes -- stop recording once the file is this big, None for no limit
+        name -- str used for logging and the thread name (ie. 'turret')
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.name = name
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.recorded = 0
+
+        self.shape = None  # of every frame in the file, set by the first frame
+        self.file = None
+        self.size = 0
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.name + '-recorder', daemon=True)
+        self.thread.start()
+
+        # Write out the queued frames and close the file when the program exits, not just when stop() is called
+        atexit.register(self.stop)
+
+    def stop(self):
+        '''Writes the frames still in the queue, then closes the file'''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def record(self, frame, timestamp=None, seq=0):
+        '''
+        Queues a frame to be written. The frame must not be written to afterwards (camera frames are new every time).
+        Returns False if it was dropped because the writer is behind.
+        '''
+        if frame is None:
+            return False
+
+        try:
+            self.queue.put_nowait((frame, time.monotonic() if timestamp is None else timestamp, seq))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    # Used in thread
+    def run(self):
+        logging.info('Recording %s frames to %s', self.name, self.path)
+
+        try:
+            while self.running or not self.queue.empty():
+                try:
+                    frame, timestamp, seq = self.queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                if self.max_bytes is not None and self.size >= self.max_bytes:
+                    continue  # full, just keep the queue empty
+
+                self.write(frame, timestamp, seq)
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+        logging.info('Recorded %d %s frames (%d dropped)', self.recorded, self.name, self.dropped)
+
+    def write(self, frame, timestamp, seq):
+        if self.file is None:
+            # The first frame sets the shape of the whole recording
+            self.shape = frame.shape
+            self.record_dtype = get_record_dtype(self.shape)
+            channels = self.shape[2] if len(self.shape) == 3 else 0
+
+            self.file = open(self.path, 'wb', buffering=0)
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION, self.shape[0], self.shape[1], channels).ljust(ALIGN, b'\0'))
+            self.size = ALIGN
+
+        if frame.shape != self.shape:
+            frame = cv2.resize(frame, (self.shape[1], self.shape[0]))
+
+        header = RECORD_HEADER.pack(seq, timestamp).ljust(ALIGN, b'\0')
+        padding = self.record_dtype.itemsize - ALIGN - frame.nbytes
+
+        # Written from the frame's own memory, without copying it into a bytes object first
+        self.file.write(header)
+        self.file.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+        if padding:
+            self.file.write(b'\0' * padding)
+
+        self.size += self.record_dtype.itemsize
+        self.recorded += 1
+
+        if self.max_bytes is not None and self.size >= self.max_bytes:
+            logging.info('Stopped recording %s, %s is full', self.name, self.path)
+
+
+class RecordingSource:
+    '''
+    Image source that records every frame of another source (see FrameRecorder) and otherwise passes it through.
+    '''
+
+    def __init__(self, source, path, max_queue=8, max_bytes=None, name='camera'):
+        '''
+        source -- image Source object to record
+        path, max_queue, max_bytes -- see FrameRecorder
+        '''
+        self.source = source
+        self.recorder = FrameRecorder(path, max_queue, max_bytes, name)
+        self.recorder.start()
+
+        self.frame = None
+        self.frame_timestamp = None
+        self.frame_seq = 0
+
+    def get_frame(self):
+        frame = self.source.get_frame()
+        if frame is None:
+            return None
+
+        if hasattr(self.source, 'get_frame_info'):
+            _, self.frame_timestamp, self.frame_seq = self.source.get_frame_info()
+        else:
+            self.frame_timestamp, self.frame_seq = time.monotonic(), self.frame_seq + 1
+
+        self.frame = frame
+        self.recorder.record(frame, self.frame_timestamp, self.frame_seq)
+        return frame
+
+    def stop(self):
+        '''Stops recording, see FrameRecorder.stop()'''
+        self.recorder.stop()
+
+    def get_frame_info(self):
+        '''Returns (frame, capture timestamp, sequence number) of the last frame returned by get_frame()'''
+        return self.frame, self.frame_timestamp, self.frame_seq
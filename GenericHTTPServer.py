@@ -1,11 +1,13 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
-import cv2
+from urllib.parse import urlsplit
+import json
 import time
 import logging
+from StreamHub import parse_stream_options
 
 
-def start_http_server(pipeline, frame_source, address, port):
+def start_http_server(pipeline, frame_source, address, port, hub, latency=None):
     '''
     Runs the http server. This function should be used as the target for a thread so that the "serve_forever" call
     doesn't stall the main thread.
@@ -14,9 +16,11 @@ def start_http_server(pipeline, frame_source, address, port):
     frame_source -- image Source object that contains a function: get_frame() that returns an image or None
     address -- str (ie. 'localhost', '10.1.92.94')
     port -- int
+    hub -- StreamHub that the pipeline's output frames are published to
+    latency -- LatencyStats served as /latency.json, None for none
     '''
     def handler(*args):
-        GenericCamHandler(pipeline, frame_source, address, port, *args)
+        GenericCamHandler(pipeline, frame_source, address, port, hub, latency, *args)
 
     server = ThreadedHTTPServer((address, port), handler)
     logging.info('server started at http://%s:%s/cam.html', address, port)
@@ -29,11 +33,13 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 
 class GenericCamHandler(BaseHTTPRequestHandler):
 
-    def __init__(self, pipeline, frame_source, address, port, *args):
+    def __init__(self, pipeline, frame_source, address, port, hub, latency, *args):
         self.pipeline = pipeline
         self.address = address
         self.port = port
         self.frame_source = frame_source
+        self.hub = hub
+        self.latency = latency
         self.frame = None  # pre-allocate image to save memory
         BaseHTTPRequestHandler.__init__(self, *args)
 
@@ -42,13 +48,19 @@ class GenericCamHandler(BaseHTTPRequestHandler):
 
     def do_GET(self):
 
-        # Split up HTTP URL so we know which page was requested
-        path_args = self.path.split('/')
+        # Split up HTTP URL so we know which page was requested (and the stream options, ie. final.mjpg?w=160&q=40)
+        url = urlsplit(self.path)
+        path = url.path
+        path_args = path.split('/')
         arg = path_args[len(path_args) - 1]  # eg. "cam" of cam.mjpg
         arg = arg[0:(len(path_args) - 7)]
 
         # If getting a camera frame
-        if self.path.endswith('.mjpg'):
+        if path.endswith('.mjpg'):
+            if arg not in self.get_stream_names():
+                self.send_error(404)
+                return
+
             self.send_response(200)
             self.send_header(
                 'Content-type',
@@ -56,40 +68,26 @@ class GenericCamHandler(BaseHTTPRequestHandler):
             )
             self.end_headers()
 
-            while True:
-                try:
-                    '''
-                    # Get the frame and process it
-                    self.frame = self.frame_source.get_frame()
-                    self.pipeline.process(self.frame)
-                    '''
-
-                    for output_frame in self.pipeline.get_output_frames():
-                        # Stream the frame
-                        name = output_frame['name']
-                        frame = output_frame['frame']
-
-                        if arg == name:
-                            img_str = cv2.imencode('.jpg', frame)[1].tobytes()
-                            self.send_header('Content-type', 'image/jpeg')
-                            self.send_header('Content-length', len(img_str))
-                            self.send_header('Cache-Control', 'no-store') # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-                            self.end_headers()
-                            self.wfile.write(img_str)
-                            self.wfile.write(b"\r\n--jpgboundary\r\n")
-                            self.wfile.flush()
-                            break
-
-                    time.sleep(0.01)
-
-                except KeyboardInterrupt:
-                    self.wfile.write(b"\r\n--jpgboundary--\r\n")
-                    break
-                except BrokenPipeError:
-                    continue
+            # The pipeline only renders this stream's frames while someone is subscribed to it
+            self.hub.subscribe(arg)
+            try:
+                self.stream_frames(arg, *parse_stream_options(url.query))
+            finally:
+                self.hub.unsubscribe(arg)
             return
 
-        if self.path.endswith('.html'):
+        # Rolling latency percentiles of every pipeline stage and end to end, see LatencyStats
+        if path.endswith('/latency.json') and self.latency is not None:
+            body = json.dumps(self.latency.get_percentiles()).encode('UTF-8')
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-length', len(body))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if path.endswith('.html'):
             # Overall webpage that serves images and data
             if arg == 'cam':
                 self.send_response(200)
@@ -100,9 +98,9 @@ class GenericCamHandler(BaseHTTPRequestHandler):
                 self.wfile.write('<html><head></head><body>'.encode('UTF-8'))
 
                 # Write image streams to webpage
-                for output_frame in self.pipeline.get_output_frames():
+                for name in self.get_stream_names():
                     self.wfile.write(('<img style="margin-right: 20px;" src="'
-                                      + self.url(output_frame['name'] + '.mjpg"') + '/>').encode('UTF-8'))
+                                      + self.url(name + '.mjpg"') + '/>').encode('UTF-8'))
 
                 # Write vision data to webpage
                 # self.wfile.write(('<embed type="text/html" src="' + self.url('data.html')
@@ -138,6 +136,51 @@ class GenericCamHandler(BaseHTTPRequestHandler):
                         continue
                 self.wfile.write('</body></html>'.encode('UTF-8'))
             '''
+
+    def get_stream_names(self):
+        # The pipeline's output frames, and the camera itself if it's streamed without re-encoding
+        return self.pipeline.get_snapshot().get_output_names() + self.hub.get_jpeg_names()
+
+    def stream_frames(self, name, width=None, quality=None, fps=None):
+        '''
+        width, quality -- of the frames for this client (see FrameStream.wait_for_jpeg()), None for the defaults
+        fps -- max frames per second sent to this client, None for every new frame
+        '''
+        seq = 0  # sequence number of the last frame sent to this client
+        next_time = time.monotonic()
+        while True:
+            try:
+                # Stay under this client's FPS, it gets the newest frame after
+                remaining = next_time - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+
+                # Sleep until the pipeline publishes a new frame for this stream (encoded once for all clients that
+                # want the same size and quality)
+                seq, img_str = self.hub.wait_for_jpeg(name, seq, 1.0, width, quality)
+                if img_str is None:
+                    continue
+
+                self.send_header('Content-type', 'image/jpeg')
+                self.send_header('Content-length', len(img_str))
+                self.send_header('Cache-Control', 'no-store') # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+                self.end_headers()
+                self.wfile.write(img_str)
+                self.wfile.write(b"\r\n--jpgboundary\r\n")
+                self.wfile.flush()
+
+                self.hub.add_sent(len(img_str))
+                if fps is not None:
+                    next_time = max(next_time, time.monotonic() - 1.0 / fps) + 1.0 / fps
+
+            except KeyboardInterrupt:
+                self.wfile.write(b"\r\n--jpgboundary--\r\n")
+                break
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away, let the handler thread finish
+                break
+
+
 '''
 Microsoft LifeCam
         Index       : 1
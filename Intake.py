@@ -1,15 +1,24 @@
+import cv2
+import functools
 import numpy as np
 from Blob import BlobDetector
+from StagedPipeline import FrameContext
+from Snapshot import FrameSnapshot, SnapshotBuffer
+from BufferPool import BufferPool
 import Utility
 import numpy as np
 
 
 class Intake:
 
-    def __init__(self):
-        # Vision data
-        self.ball_detected = False
+    def __init__(self, use_lut=False, blur_mode='gaussian'):
+        '''
+        use_lut (bool): True to threshold with precompiled BGR lookup tables instead of cvtColor + inRange
+            (see HSVThreshold)
 
+        blur_mode (str): how the shared blur is computed, 'gaussian' (exact), or the cheaper 'box' or 'pyramid'
+            approximations (see Utility.blur)
+        '''
         # Vision constants
         self.max_balls = 5
         self.min_balls = 1
@@ -23,37 +32,102 @@ class Intake:
         self.red_hsv_lower2 = np.array([170, 87, 0])
         self.red_hsv_upper2 = np.array([180, 255, 255])
 
+        # Every frame-sized array is allocated once and reused (see BufferPool)
+        self.pool = BufferPool('intake')
+
         # Blob detectors
-        self.blue_blob_detector = BlobDetector(self.blue_hsv_lower, self.blue_hsv_upper)
+        self.blue_blob_detector = BlobDetector(self.blue_hsv_lower, self.blue_hsv_upper, use_lut=use_lut,
+                                               pool=self.pool)
         self.red_blob_detector = BlobDetector(self.red_hsv_lower, self.red_hsv_upper, self.red_hsv_lower2,
-                                              self.red_hsv_upper2)
+                                              self.red_hsv_upper2, use_lut=use_lut, pool=self.pool)
+
+        # Shared preprocessing, done once per frame for both blob detectors
+        self.use_lut = use_lut
+        self.blur_mode = blur_mode
+        self.blur_radius = self.blue_blob_detector.blur_radius
+        self.ksize_blur = self.blue_blob_detector.ksize_blur
 
-        self.output_frame = None
+        # Vision data: the values and output frame of the last frame, published together (see FrameSnapshot)
+        self.snapshots = SnapshotBuffer(FrameSnapshot(0, (False, ), [('final', None)]))
 
-    # Returned frame must be same size as input frame. Draw on the given frame.
+    # The frame isn't drawn on, the annotated output frame is a copy rendered when it's streamed (see render)
     def process(self, frame):
+        # Run every stage in order (StagedPipeline runs them on separate threads instead)
+        ctx = FrameContext(frame)
+        for stage in self.get_stages():
+            ctx.run(stage)
+
+    def get_stages(self):
+        '''Returns the stages of process() in order, see Turret.get_stages()'''
+        return [self.preprocess_stage, self.detect_stage, self.publish_stage]
+
+    def preprocess_stage(self, ctx):
+        # Blur and convert to HSV once for both colors (the LUT thresholds don't need HSV). Into frames from the pool,
+        # since the detect stage may still be using the last ones.
+        blur_frame = self.pool.acquire(ctx.frame.shape)
+        small = self.pool.acquire(Utility.get_pyramid_shape(ctx.frame.shape)) if self.blur_mode == 'pyramid' else None
+        ctx.blur_frame = self.pool.reuse(Utility.blur(ctx.frame, round(self.blur_radius), self.ksize_blur,
+                                                      self.blur_mode, blur_frame, small), blur_frame)
+        self.pool.release(small)
+        ctx.hsv_frame = None
+        if not self.use_lut:
+            hsv_frame = self.pool.acquire(ctx.frame.shape)
+            ctx.hsv_frame = self.pool.reuse(cv2.cvtColor(ctx.blur_frame, cv2.COLOR_BGR2HSV, dst=hsv_frame), hsv_frame)
+
+    def detect_stage(self, ctx):
         # Find blue blobs
-        num_blue = self.blue_blob_detector.process(frame)
+        ctx.blue_circles = self.blue_blob_detector.detect_blurred(ctx.frame.shape, ctx.blur_frame, ctx.hsv_frame)
 
         # Find red blobs
-        num_red = self.red_blob_detector.process(frame)
+        ctx.red_circles = self.red_blob_detector.detect_blurred(ctx.frame.shape, ctx.blur_frame, ctx.hsv_frame)
+
+        # Only the detect stage uses these
+        self.pool.release(ctx.blur_frame)
+        self.pool.release(ctx.hsv_frame)
+        ctx.blur_frame = ctx.hsv_frame = None
 
-        self.output_frame = np.copy(frame)
+    def publish_stage(self, ctx):
+        num_blue = 0 if ctx.blue_circles is None else len(ctx.blue_circles)
+        num_red = 0 if ctx.red_circles is None else len(ctx.red_circles)
 
         if self.min_balls <= num_red + num_blue <= self.max_balls:
-            self.ball_detected = True
+            ball_detected = True
         else:
-            self.ball_detected = False
+            ball_detected = False
+
+        # The annotated frame is only drawn if someone watches the stream
+        final = functools.partial(self.render, ctx)
+        self.snapshots.publish(FrameSnapshot(ctx.frame_seq, (ball_detected, ), [('final', final)], ctx.capture_time))
+        self.pool.end_frame()
+
+    def drop_frame(self, ctx):
+        '''Gives the blurred and HSV frames of a frame that won't be published back to the pool (see StagedPipeline)'''
+        self.pool.release(getattr(ctx, 'blur_frame', None))
+        self.pool.release(getattr(ctx, 'hsv_frame', None))
+        ctx.blur_frame = ctx.hsv_frame = None
 
-        # utility.put_text_group(frame, ('Balls? ' + str(self.ball_detected), ))
+    def render(self, ctx):
+        '''Returns a copy of the frame with the circles of both colors drawn on (for the stream)'''
+        frame = np.copy(ctx.frame)
+        if ctx.blue_circles is not None:
+            self.blue_blob_detector.draw_circles(frame, ctx.blue_circles)
+        if ctx.red_circles is not None:
+            self.red_blob_detector.draw_circles(frame, ctx.red_circles)
+
+        # utility.put_text_group(frame, ('Balls? ' + str(ball_detected), ))
+
+        return frame
 
     def get_output_values(self):
-        return (self.ball_detected, )  # return tuple
+        return self.snapshots.latest().get_output_values()  # return tuple
 
     def get_output_frames(self):
-        return [
-            {
-                'name': 'final',
-                'frame': self.output_frame
-            },
-        ]
+        return self.snapshots.latest().get_output_frames()
+
+    # Values and output frame of the same frame, see FrameSnapshot
+    def get_snapshot(self):
+        return self.snapshots.latest()
+
+    # Frame-sized allocations per frame, should be 0 once running (see BufferPool)
+    def get_allocations_per_frame(self):
+        return self.pool.get_allocations_per_frame()
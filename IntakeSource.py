@@ -1,32 +1,106 @@
 import cv2
+import time
 import logging
 
+from FrameGrabber import FrameGrabber
+import Utility
+
 
 class IntakeSource:
 
-    def __init__(self, jetson=True):
+    def __init__(self, jetson=True, threaded=False, mjpeg=False):
+        '''
+        jetson (bool): True if reading from /dev/cam/intake on the Jetson, False for the second local webcam.
+
+        threaded (bool): True to read the camera in a background FrameGrabber thread. get_frame() then returns the newest
+            frame without waiting on the camera, instead of reading one synchronously.
+
+        mjpeg (bool): True to read the camera's own MJPEG frames and decode them here, only when get_frame() returns
+            one (so frames the grabber drops are never decoded). The JPEG bytes go to the add_jpeg_listener() functions
+            as they are, so the camera can be streamed without encoding it again.
+        '''
         self.jetson = jetson
 
         self.cap = None  # VideoCapture object
         self.frame = None  # the image frame, pre-allocated to save memory
 
+        # Metadata of the last frame returned by get_frame()
+        self.frame_timestamp = None  # time.monotonic() when the frame was captured
+        self.frame_seq = 0  # increases by one for every new camera frame
+
+        self.mjpeg = mjpeg
+        self.jpeg_listeners = []  # functions(jpeg) called for every camera frame in mjpeg mode
+
+        self.grabber = FrameGrabber(self.open_cap, 'intake') if threaded else None
+        if self.grabber is not None:
+            self.grabber.start()
+
+    def open_cap(self):
+        if self.jetson:
+            cap = cv2.VideoCapture('/dev/cam/intake', cv2.CAP_V4L)
+        else:
+            cap = cv2.VideoCapture(1)
+
+        # stream_res = (160, 120)
+        # cap.set(cv2.CAP_PROP_FRAME_WIDTH, stream_res[0])
+        # cap.set(cv2.CAP_PROP_FRAME_HEIGHT, stream_res[1])
+
+        if self.mjpeg and not Utility.request_mjpeg(cap):
+            logging.info('Intake camera can\'t give out undecoded MJPEG, decoding as usual')
+
+        return cap
+
     def get_frame(self):
 
+        # Take the newest frame from the grabber thread, waiting briefly if we've already seen it
+        if self.grabber is not None:
+            frame, timestamp, seq = self.grabber.get_latest(self.frame_seq, timeout=0.5)
+            if frame is None:
+                return None
+
+            self.frame, self.frame_timestamp, self.frame_seq = self.decode(frame), timestamp, seq
+            return self.frame
+
         # If the VideoCapture is not initialized
         if self.cap is None or (not self.cap.isOpened()):
             logging.info('Trying to initialize intake cap...')
+            self.cap = self.open_cap()
 
-            if self.jetson:
-                self.cap = cv2.VideoCapture('/dev/cam/intake', cv2.CAP_V4L)
-            else:
-                self.cap = cv2.VideoCapture(1)
+        _, frame = self.cap.read()
+        self.frame_timestamp = time.monotonic()
+        self.frame_seq += 1
 
-            # stream_res = (160, 120)
-            # self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, stream_res[0])
-            # self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, stream_res[1])
-
-        _, self.frame = self.cap.read()
+        if Utility.is_jpeg(frame):
+            self.publish_jpeg(frame)
+        self.frame = self.decode(frame)
 
         return self.frame
 
+    def decode(self, frame):
+        # In mjpeg mode the cap returns the camera's JPEG (unless the backend decoded it anyway)
+        if Utility.is_jpeg(frame):
+            return cv2.imdecode(frame, cv2.IMREAD_COLOR)
+        return frame
+
+    def add_jpeg_listener(self, listener):
+        '''
+        listener -- function(jpeg) called with every camera frame in mjpeg mode, from the grabber thread if any. jpeg is
+            the uint8 array read() returned, not copied to bytes since nobody may be watching (see StreamHub)
+        '''
+        if not self.jpeg_listeners and self.grabber is not None:
+            self.grabber.add_listener(self.on_grabbed)
+        self.jpeg_listeners.append(listener)
+
+    # Called from the grabber thread for every camera frame, also the ones get_frame() never returns
+    def on_grabbed(self, frame, timestamp, seq):
+        if Utility.is_jpeg(frame):
+            self.publish_jpeg(frame)
+
+    def publish_jpeg(self, jpeg):
+        if self.jpeg_listeners:
+            for listener in list(self.jpeg_listeners):
+                listener(jpeg)
 
+    def get_frame_info(self):
+        '''Returns (frame, capture timestamp, sequence number) of the last frame returned by get_frame()'''
+        return self.frame, self.frame_timestamp, self.frame_seq
@@ -0,0 +1,71 @@
+import collections
+import threading
+import time
+import logging
+
+
+class LatencyStats:
+    '''
+    Rolling latency percentiles (p50/p95/p99) of every pipeline stage and of each pipeline end to end, to know how
+    stale the values the robot gets are. Latencies are recorded by name (ie. 'turret.threshold' for a stage,
+    'turret.pipeline' from capture until the pipeline is done and 'turret.send' from capture until the socket send).
+
+    record() only appends to a bounded deque, so it can stay on in a match. The percentiles are only computed when
+    someone asks for them (ie. /latency.json on the stream servers, or the periodic log line).
+    '''
+
+    def __init__(self, window=1000, log_interval=10.0):
+        '''
+        window -- latest samples of each name that the percentiles are computed over
+        log_interval -- seconds between the log lines of log_if_due(), None to never log
+        '''
+        self.window = window
+        self.log_interval = log_interval
+
+        self.samples = {}  # name -> deque of the latest latencies in seconds
+        self.lock = threading.Lock()  # only for adding names, appending to a deque is thread safe
+        self.last_log_time = time.monotonic()
+
+    def record(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples is None:
+            with self.lock:
+                samples = self.samples.setdefault(name, collections.deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def record_stages(self, pipeline_name, ctx):
+        '''Records how long each stage took for the FrameContext ctx, see FrameContext.run()'''
+        for stage_name, start, end in ctx.stage_times:
+            if stage_name.endswith('_stage'):
+                stage_name = stage_name[:-len('_stage')]
+            self.record(pipeline_name + '.' + stage_name, end - start)
+
+    def get_percentiles(self):
+        '''Returns dict of name -> {'count', 'p50', 'p95', 'p99'}, in milliseconds'''
+        with self.lock:
+            names = sorted(self.samples)
+
+        percentiles = {}
+        for name in names:
+            samples = sorted(self.samples[name])
+            if not samples:
+                continue
+
+            percentiles[name] = {'count': len(samples)}
+            for p in (50, 95, 99):
+                index = min(len(samples) - 1, int(len(samples) * p / 100))
+                percentiles[name]['p' + str(p)] = round(samples[index] * 1000, 2)
+
+        return percentiles
+
+    def log_if_due(self):
+        '''Logs one line of every p50/p95/p99 (in ms) if log_interval seconds went by since the last one'''
+        now = time.monotonic()
+        if self.log_interval is None or now - self.last_log_time < self.log_interval:
+            return
+        self.last_log_time = now
+
+        percentiles = self.get_percentiles()
+        if percentiles:
+            logging.info('latency ms p50/p95/p99: %s', ', '.join(
+                '%s %.1f/%.1f/%.1f' % (name, p['p50'], p['p95'], p['p99']) for name, p in percentiles.items()))
@@ -3,21 +3,34 @@
 from Turret import Turret
 from Intake import Intake
 import threading
-import socket
 import time
 import logging
 from logging.handlers import RotatingFileHandler
 import sys
 
 from GenericHTTPServer import start_http_server
+from AsyncHTTPServer import start_async_http_server
+from StreamHub import StreamHub, BandwidthBudget
 from TurretSource import TurretSource
 from IntakeSource import IntakeSource
-from StaticImageSource import StaticImageSource
+from CachedImageSource import CachedImageSource
+from FrameRecorder import RecordingSource
+from PipelineScheduler import PipelineScheduler
+from SharedMemoryPipeline import ProcessPipeline
+from UDPPublisher import UDPPublisher
+from TelemetryServer import TelemetryServer
+from ResultBus import ResultBus
+from LatencyStats import LatencyStats
+import Telemetry
 
 
 class Main:
 
-    def __init__(self, jetson, connect_socket, turret_source=None, intake_source=None):
+    def __init__(self, jetson, connect_socket, turret_source=None, intake_source=None, threaded_capture=True,
+                 stream_server='threaded', turret=None, intake=None, turret_fps=None, intake_fps=15,
+                 multiprocess=False, frame_shape=(480, 640, 3), pipelined=False, telemetry_format='binary',
+                 udp_subscribers=None, measure_latency=True, record_turret=None, mjpeg=False,
+                 stream_mbps=None):
         '''
         jetson (bool): True if running on Jetson, False otherwise.
             This controls the address and port #s, as well as the image sources for turret and intake
@@ -27,9 +40,55 @@ class Main:
             5800
 
         turret_source (image source object): Leave None if you want the video capture to be the image source for the
-            vision pipeline. Options: None or StaticImageSource obj
+            vision pipeline. Options: None, StaticImageSource, CachedImageSource or ReplaySource obj
 
         intake_source: same as turret_source but for intake duh
+
+        threaded_capture (bool): True if the default camera sources should read frames in a background grabber thread
+            (see FrameGrabber), so the pipelines always get the newest frame without waiting on the camera.
+
+        stream_server (str): 'threaded' to serve the HTTP streams with one thread per viewer (GenericHTTPServer), or
+            'asyncio' to serve every viewer from a single event loop (AsyncHTTPServer).
+
+        turret (Turret): Leave None to use the default Turret pipeline. Pass one in to change its options
+            (ie. Turret(tracking=True)).
+
+        intake (Intake): same as turret but for intake
+
+        turret_fps, intake_fps (float): max frames per second each pipeline processes, None for as fast as possible.
+            The turret runs at a higher priority than the intake.
+
+        multiprocess (bool): True to run each camera's capture and pipeline in their own processes (see ProcessPipeline)
+            instead of threads, so they can use all the Jetson's cores. Linux only.
+
+        frame_shape (tuple): shape of the camera frames in multiprocess mode. Frames of other sizes are resized to this.
+
+        pipelined (bool): True to run the stages of each pipeline on their own threads (see StagedPipeline), so the next
+            frame is thresholded while the last one is still being filtered and drawn. False runs them one after the
+            other (easier to debug). Threaded mode only.
+
+        telemetry_format (str): 'binary' to send the robot a fixed-layout message with frame numbers and timestamps
+            (see Telemetry), or 'text' for the legacy str(output values) lines. Either way, a message is sent as soon as
+            a pipeline has a new result.
+
+        udp_subscribers (list): (host, port) addresses to also send every result to as a binary UDP datagram
+            (see UDPPublisher), ie. [('10.1.92.2', 5805), ('10.1.92.5', 5805)]. None for no UDP. Works with or without
+            connect_socket.
+
+        measure_latency (bool): True to keep rolling p50/p95/p99 latencies of every pipeline stage and from capture to
+            the socket send (see LatencyStats). They are logged every 10 seconds and served as /latency.json by the
+            stream servers.
+
+        record_turret (str): file to record every turret camera frame to (see FrameRecorder), as a black box of what the
+            turret saw. Play it back with ReplaySource as the turret_source. None to not record.
+
+        mjpeg (bool): True to have the default camera sources keep the cameras' own MJPEG frames and only decode the
+            ones the pipelines take. The undecoded frames are streamed as /camera.mjpg without encoding them again.
+            Threaded mode only (multiprocess still decodes in the capture process, but has no /camera.mjpg).
+
+        stream_mbps (float): total megabits per second all the HTTP streams together should stay under (ie. 3.0 to
+            leave room on the field network). Once they go over, every stream's JPEG quality is lowered until they fit
+            (see BandwidthBudget). None for no limit. Each viewer can also ask for less with ?w=160&q=40&fps=10.
         '''
         # Logs to file
         # logging.basicConfig(handlers=[RotatingFileHandler('print.log', maxBytes=10*1024)], level=logging.INFO)
@@ -39,8 +98,8 @@ class Main:
 
         logging.info('Entered Main')
         # Initialize vision pipelines
-        self.turret = Turret()
-        self.intake = Intake()
+        self.turret = Turret() if turret is None else turret
+        self.intake = Intake() if intake is None else intake
 
         if jetson:
             address = '10.1.92.12'
@@ -52,25 +111,137 @@ class Main:
         # Save flag variables
         self.connect_socket = connect_socket
         self.jetson = jetson
+        self.telemetry_format = telemetry_format
+
+        # Every pipeline result goes through here, to the socket, UDP, the HTTP streams and the log
+        self.results = ResultBus(('turret', 'intake'))
+        self.latency = LatencyStats() if measure_latency else None
+
+        # Output frames are published to these after each process() call and rendered and encoded once for every stream
+        # client
+        budget = BandwidthBudget(stream_mbps * 1e6 / 8) if stream_mbps else None  # shared, it's one network
+        self.turret_hub = StreamHub(budget)
+        self.intake_hub = StreamHub(budget)
+        self.results.add_listener(self.publish_frames)
+
+        if multiprocess:
+            # Sources are created inside the capture processes, so the camera threads and handles live there
+            make_turret_source = (lambda: TurretSource(jetson, threaded_capture, mjpeg)) if turret_source is None \
+                else (lambda: turret_source)
+            if record_turret is not None:
+                make_camera_source = make_turret_source
+                make_turret_source = lambda: RecordingSource(make_camera_source(), record_turret, name='turret')
+            make_intake_source = (lambda: IntakeSource(jetson, threaded_capture, mjpeg)) if intake_source is None \
+                else (lambda: intake_source)
+            self.turret_source = None
+            self.intake_source = None
 
-        # Instantiate turret and intake source objects
-        self.turret_source = TurretSource(jetson) if turret_source is None else turret_source
-        self.intake_source = IntakeSource(jetson) if intake_source is None else intake_source
+            # Fork the pipeline processes before starting any threads; the proxies then stand in for the pipelines
+            h, w = frame_shape[:2]
+            self.turret = ProcessPipeline('turret', make_turret_source, self.turret, frame_shape,
+                                          {'mask': (h, w), 'final': frame_shape}, turret_fps,
+                                          on_result=lambda p: self.on_result('turret'))
+            self.intake = ProcessPipeline('intake', make_intake_source, self.intake, frame_shape,
+                                          {'final': frame_shape}, intake_fps, niceness=1,
+                                          on_result=lambda p: self.on_result('intake'))
+            self.turret.start()
+            self.intake.start()
+            self.turret.start_listener()
+            self.intake.start_listener()
+        else:
+            # Instantiate turret and intake source objects
+            self.turret_source = TurretSource(jetson, threaded_capture, mjpeg) if turret_source is None \
+                else turret_source
+            self.intake_source = IntakeSource(jetson, threaded_capture, mjpeg) if intake_source is None \
+                else intake_source
+
+            # Stream the cameras' own JPEGs as they come in, without decoding or encoding them
+            if mjpeg:
+                for source, hub in ((self.turret_source, self.turret_hub), (self.intake_source, self.intake_hub)):
+                    if hasattr(source, 'add_jpeg_listener'):
+                        source.add_jpeg_listener(lambda jpeg, hub=hub: hub.publish_jpeg('camera', jpeg))
+            if record_turret is not None:
+                self.turret_source = RecordingSource(self.turret_source, record_turret, name='turret')
+
+            # Start vision pipeline threads (one per camera)
+            self.scheduler = PipelineScheduler(latency=self.latency)
+            self.scheduler.register('turret', self.turret_source, self.turret, turret_fps, priority=1,
+                                    on_result=lambda worker: self.on_result('turret'),
+                                    pipelined=pipelined)
+            self.scheduler.register('intake', self.intake_source, self.intake, intake_fps, priority=0,
+                                    on_result=lambda worker: self.on_result('intake'),
+                                    pipelined=pipelined)
+            self.scheduler.start()
 
         # Start threads
         logging.info('Starting threads...')
-        turret_thread = threading.Thread(target=start_http_server, args=(self.turret, self.turret_source, address, ports[0]))
-        intake_thread = threading.Thread(target=start_http_server, args=(self.intake, self.intake_source, address, ports[1]))
+        self.udp_publisher = None
+        if udp_subscribers:
+            # Always binary, since receivers need the msg_seq to drop stale datagrams
+            self.udp_publisher = UDPPublisher(lambda seq, timeout: self.wait_for_message(seq, timeout, 'binary'),
+                                              udp_subscribers)
+            self.udp_publisher.start()
+
+        server = start_async_http_server if stream_server == 'asyncio' else start_http_server
+        turret_thread = threading.Thread(target=server, args=(self.turret, self.turret_source, address, ports[0],
+                                                              self.turret_hub, self.latency))
+        intake_thread = threading.Thread(target=server, args=(self.intake, self.intake_source, address, ports[1],
+                                                              self.intake_hub, self.latency))
         turret_thread.start()
         intake_thread.start()
 
-        # Start vision pipeline threads
-        turret_vision_thread = threading.Thread(target=self.run_pipelines)
-        turret_vision_thread.start()
-
         # Run the main code
         self.run()
 
+    # Called from the pipeline (or result listener) threads after every processed frame
+    def on_result(self, name):
+        # Values and frames from the same snapshot, so the streams always show what was sent to the robot
+        snapshot = (self.turret if name == 'turret' else self.intake).get_snapshot()
+        if self.latency is not None and snapshot.capture_time is not None:
+            self.latency.record(name + '.pipeline', snapshot.done_time - snapshot.capture_time)
+        self.results.publish(name, snapshot.values, snapshot.frame_id, snapshot.capture_time, snapshot.done_time,
+                             snapshot)
+
+    # Result bus listener, hands the snapshot of the pipeline that just finished to its stream hub. Output frames are
+    # only rendered for the streams someone is watching.
+    def publish_frames(self, name, snapshot):
+        hub = self.turret_hub if name == 'turret' else self.intake_hub
+        hub.publish_snapshot(snapshot)
+
+        # Pipeline processes only send back the frames of the watched streams
+        pipeline = self.turret if name == 'turret' else self.intake
+        if hasattr(pipeline, 'set_watched'):
+            pipeline.set_watched(hub.get_watched_names())
+
+    # Returns the next message to send the robot, waiting up to timeout seconds for a result newer than after_seq.
+    # Returns (result seq, message bytes), or (after_seq, None) on timeout. telemetry_format None for the Main one.
+    def wait_for_message(self, after_seq, timeout=None, telemetry_format=None):
+        result_seq, source, results = self.results.wait_for_next(after_seq, timeout)
+        if results is None:
+            return after_seq, None
+
+        return result_seq, self.pack_message(result_seq, source, results, telemetry_format)
+
+    # Returns the message bytes of a result from the ResultBus
+    def pack_message(self, result_seq, source, results, telemetry_format=None):
+        turret_result = results['turret']
+        intake_result = results['intake']
+
+        if (telemetry_format or self.telemetry_format) == 'text':
+            return Telemetry.pack_text(turret_result, intake_result)
+
+        source_id = Telemetry.SOURCE_TURRET if source == 'turret' else Telemetry.SOURCE_INTAKE
+        return Telemetry.pack_binary(result_seq, source_id, turret_result, intake_result)
+
+    # Records how long ago the frame of the result that was just sent (the newest of source) was captured
+    def record_send_latency(self, source, results):
+        if self.latency is None or results.get(source) is None:
+            return  # nothing published yet
+
+        capture_time = results[source][1]
+        if capture_time is not None:
+            self.latency.record(source + '.send', time.monotonic() - capture_time)
+
     # Just run once! Infinite loop that keeps the streaming threads alive whilst sending socket data (if applicable)
     def run(self):
         if self.connect_socket:
@@ -81,45 +252,42 @@ class Main:
                 HOST = ''  # Empty string to accept connections on all available IPv4 interfaces
                 PORT = 1337  # Port to listen on (non-privileged ports are > 1023)
 
-            # Connect to socket
-            while True:
-                try:
-                    logging.info('Attempting to connect')
-
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.bind((HOST, PORT))
-                        s.listen()
-                        conn, addr = s.accept()
-                        with conn:
-                            logging.info('Connected by %s', addr)
-
-                            # Send data over socket connection
-                            while True:
-                                output_data = self.turret.get_output_values() + self.intake.get_output_values()
-                                logging.info('send data %s', str(output_data))
-                                conn.send(bytes(str(output_data) + "\n", "UTF-8"))
-                                time.sleep(0.1)
-                            break
-
-                except (BrokenPipeError, ConnectionResetError, ConnectionRefusedError) as e:
-                    logging.info('Connection lost... retrying')
-                except KeyboardInterrupt as e:
-                    break
+            # One listening socket for the whole run, so the robot can reconnect (or a second client attach) any time
+            server = TelemetryServer(HOST, PORT)
+            server.start()
+
+            # Send data to every client as soon as there's a new result
+            # Start with the newest result, or wait for the first one if nothing was published yet (seq 0 has no source)
+            sent_seq = max(0, self.results.latest()[0] - 1)
+            try:
+                while True:
+                    sent_seq, source, results = self.results.wait_for_next(sent_seq, timeout=1.0)
+                    if results is not None:
+                        message = self.pack_message(sent_seq, source, results)
+                        logging.debug('send data %s', message)
+                        server.broadcast(message)
+                        self.record_send_latency(source, results)
+
+                    if self.latency is not None:
+                        self.latency.log_if_due()
+            except KeyboardInterrupt:
+                server.stop()
         else:
-            while True:
-                output_data = self.turret.get_output_values() + self.intake.get_output_values()
-                # print(str(output_data))
+            # Nothing to send, just wait for results (without spinning) and log them
+            seq = 0
+            try:
+                while True:
+                    seq, _, results = self.results.wait_for_next(seq, timeout=1.0)
+                    if results is not None:
+                        logging.debug('results %s', results)
 
-    # Continually process frames and run vision pipelines
-    # Used in thread
-    def run_pipelines(self):
-        while True:
-            # Run turret pipeline
-            self.turret_frame = self.turret_source.get_frame()  # gets frame (put in allocated turret_frame var)
-            self.turret.process(self.turret_frame)  # process frame
+                    if self.latency is not None:
+                        self.latency.log_if_due()
+            except KeyboardInterrupt:
+                pass
 
 
 if __name__ == '__main__':
     # Main(jetson=False, connect_socket=False)
-    Main(jetson=False, connect_socket=True, turret_source=StaticImageSource('images_2/image_1.png'),
-         intake_source=StaticImageSource('images/106.25_1.0.png'))
+    Main(jetson=False, connect_socket=True, turret_source=CachedImageSource('images_2/image_1.png', fps=30),
+         intake_source=CachedImageSource('images/106.25_1.0.png', fps=30))
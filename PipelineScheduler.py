@@ -0,0 +1,158 @@
+import collections
+import threading
+import time
+import os
+import logging
+from StagedPipeline import StagedPipeline
+
+
+class PipelineScheduler:
+    '''
+    Runs every registered (source, pipeline) pair on its own worker thread, each with its own target FPS and priority,
+    so a slow pipeline can't hold back the others.
+    '''
+
+    def __init__(self, log_interval=10.0, latency=None):
+        '''
+        log_interval -- seconds between logging each pipeline's achieved FPS, None to never log
+        latency -- LatencyStats to record the time of every pipeline stage in, None to not measure
+        '''
+        self.workers = collections.OrderedDict()
+        self.log_interval = log_interval
+        self.latency = latency
+
+    def register(self, name, source, pipeline, target_fps=None, priority=0, on_result=None, pipelined=False):
+        '''
+        name -- str used for logging and get_fps() (ie. 'turret')
+        source -- image Source object that contains a function: get_frame() that returns an image or None
+        pipeline -- pipeline object as specified by GenericPipeline
+        target_fps -- max frames per second to process, None to run as fast as frames come in
+        priority -- int, higher runs first when the CPU is busy. Workers below the highest priority get a higher
+            nice value (Linux only).
+        on_result -- function(worker) called after every processed frame (ie. to publish the stream frames)
+        pipelined -- True to run the stages of the pipeline (see get_stages() of Turret and Intake) on separate threads
+            with a StagedPipeline, so the next frame is already being processed while the last one is finished
+        '''
+        self.workers[name] = PipelineWorker(name, source, pipeline, target_fps, priority, on_result, self.log_interval,
+                                            pipelined, self.latency)
+
+    def start(self):
+        highest_priority = max(worker.priority for worker in self.workers.values())
+
+        for worker in self.workers.values():
+            worker.start(niceness=highest_priority - worker.priority)
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    def get_fps(self):
+        '''Returns the achieved FPS of each pipeline by name, to see when a camera is starved'''
+        return {name: worker.get_fps() for name, worker in self.workers.items()}
+
+
+class PipelineWorker:
+
+    def __init__(self, name, source, pipeline, target_fps=None, priority=0, on_result=None, log_interval=None,
+                 pipelined=False, latency=None):
+        self.name = name
+        self.source = source
+        self.pipeline = pipeline
+        self.target_fps = target_fps
+        self.priority = priority
+        self.on_result = on_result
+        self.log_interval = log_interval
+        self.latency = latency
+
+        # Serial runs every stage right on the worker thread
+        self.staged = StagedPipeline(pipeline, pipelined, on_result=self.handle_result, name=name)
+
+        # Metadata of the last processed frame
+        self.frame = None
+        self.frame_seq = 0
+        self.capture_time = None  # time.monotonic() when the frame was captured (if the source knows)
+        self.done_time = None  # time.monotonic() when process() finished
+
+        self.frame_times = collections.deque(maxlen=30)  # done times of the last processed frames, for the FPS
+        self.last_log_time = time.monotonic()
+
+        self.running = False
+        self.thread = None
+
+    def start(self, niceness=0):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(niceness, ), name=self.name + '-pipeline', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.staged.stop()
+
+    # Used in thread
+    def run(self, niceness=0):
+        if niceness > 0:
+            self.set_niceness(niceness)
+
+        # Started from here so the stage threads get the same niceness
+        self.staged.start()
+
+        period = 1.0 / self.target_fps if self.target_fps else 0
+        seq = 0
+
+        while self.running:
+            start_time = time.monotonic()
+
+            frame = self.source.get_frame()
+            if frame is None:  # camera not ready yet
+                time.sleep(0.01)
+                continue
+
+            if hasattr(self.source, 'get_frame_info'):
+                _, capture_time, frame_seq = self.source.get_frame_info()
+            else:
+                seq += 1
+                capture_time, frame_seq = start_time, seq
+
+            # Calls handle_result() when the frame is done (right away unless pipelined)
+            self.staged.process(frame, frame_seq, capture_time)
+
+            # Stay under the target FPS
+            remaining = period - (time.monotonic() - start_time)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    # Called by the last stage of every frame
+    def handle_result(self, ctx):
+        self.frame = ctx.frame
+        self.frame_seq = ctx.frame_seq
+        self.capture_time = ctx.capture_time
+        self.done_time = time.monotonic()
+        self.frame_times.append(self.done_time)
+
+        if self.latency is not None:
+            self.latency.record_stages(self.name, ctx)
+
+        if self.on_result is not None:
+            self.on_result(self)
+
+        if self.log_interval is not None and self.done_time - self.last_log_time >= self.log_interval:
+            logging.info('%s pipeline: %.1f fps (target %s)', self.name, self.get_fps(), self.target_fps)
+            self.last_log_time = self.done_time
+
+    def set_niceness(self, niceness):
+        # Threads are scheduled separately on Linux, so this only lowers the priority of this worker's thread
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), os.getpriority(os.PRIO_PROCESS, 0) + niceness)
+        except (AttributeError, OSError) as e:
+            logging.info('Could not lower the priority of the %s pipeline: %s', self.name, e)
+
+    def get_fps(self):
+        frame_times = list(self.frame_times)
+        if len(frame_times) < 2:
+            return 0.0
+
+        # Measured up to now rather than the last frame, so a camera that stopped shows up as starved
+        return (len(frame_times) - 1) / (time.monotonic() - frame_times[0])
@@ -0,0 +1,46 @@
+import threading
+
+
+class PixelTable:
+    '''
+    Lazily built per-pixel lookup table, ie. the angles and distance to a target at each pixel of the frame.
+
+    build -- function(frame_shape) that returns a float array of shape (h, w, n): n values for every pixel.
+        It is only called the first time a frame shape is looked up, and again after invalidate().
+    '''
+
+    def __init__(self, build):
+        self.build = build
+        self.table = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        '''Throw away the table (ie. after the calibration changes), it is rebuilt on the next lookup'''
+        with self.lock:
+            self.table = None
+
+    def get_table(self, frame_shape):
+        with self.lock:
+            if self.table is None or self.table.shape[:2] != tuple(frame_shape[:2]):
+                self.table = self.build(frame_shape)
+            return self.table
+
+    def lookup(self, frame_shape, x, y):
+        '''Returns the n values at sub-pixel position (x, y), bilinearly interpolated from the 4 nearest pixels'''
+        table = self.get_table(frame_shape)
+        h, w = table.shape[:2]
+
+        x = min(max(float(x), 0.0), w - 1.0)
+        y = min(max(float(y), 0.0), h - 1.0)
+        x0 = min(int(x), w - 2) if w > 1 else 0
+        y0 = min(int(y), h - 2) if h > 1 else 0
+        fx = x - x0
+        fy = y - y0
+
+        # Plain python floats are much faster than NumPy for a handful of values
+        corners = table[y0:y0 + 2, x0:x0 + 2].tolist()
+        top_left, top_right = corners[0][0], corners[0][-1]
+        bottom_left, bottom_right = corners[-1][0], corners[-1][-1]
+
+        return [(tl * (1 - fx) + tr * fx) * (1 - fy) + (bl * (1 - fx) + br * fx) * fy
+                for tl, tr, bl, br in zip(top_left, top_right, bottom_left, bottom_right)]
@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+import numpy as np
+
+from FrameRecorder import MAGIC, FILE_HEADER, ALIGN, get_record_dtype
+
+
+class ReplaySource:
+    '''
+    Image source that plays back a recording made by FrameRecorder, to profile and debug the pipelines offline on what
+    a camera actually saw in a match.
+
+    The file is memory-mapped, so get_frame() returns read-only views straight into it without decoding or copying.
+    Frames play at the recorded speed ('realtime'), at a fixed FPS, or as fast as they're asked for ('max').
+    '''
+
+    def __init__(self, path, rate='realtime', loop=True, drop_late=True):
+        '''
+        path -- recording file
+        rate -- 'realtime' to wait out the recorded time between frames, a number for a fixed FPS, or 'max' to never wait
+        loop -- True to start over after the last frame, False to return None from then on
+        drop_late -- in realtime, True to skip the frames that are already late (like a camera does when the pipeline
+            is slow), False to play every frame in order no matter what (same frames every run)
+        '''
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+        self.drop_late = drop_late
+
+        with open(path, 'rb') as f:
+            magic, version, h, w, channels = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + ' is not a frame recording')
+
+        self.shape = (h, w, channels) if channels else (h, w)
+        record_dtype = get_record_dtype(self.shape)
+
+        # A recording that was cut off (ie. the robot lost power) ends with a partial record, leave it out
+        count = (os.path.getsize(path) - ALIGN) // record_dtype.itemsize
+        if count <= 0:
+            raise ValueError(path + ' has no frames')
+
+        self.records = np.memmap(path, dtype=record_dtype, mode='r', offset=ALIGN, shape=(count, ))
+        self.frames = self.records['frame']  # views into the file
+        self.timestamps = np.array(self.records['timestamp'])  # recorded capture times, read once
+        logging.info('Replaying %d frames of %s from %s', count, self.shape, path)
+
+        self.index = -1  # of the last frame returned
+        self.start_time = None  # time.monotonic() the first frame of this pass was returned at
+        self.next_time = None  # time.monotonic() the next frame is due at, for a fixed rate
+
+        # Metadata of the last frame returned by get_frame()
+        self.frame = None
+        self.frame_timestamp = None
+        self.frame_seq = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_frame(self):
+        index = self.get_next_index()
+        if index is None:
+            return None
+
+        self.index = index
+        self.frame = self.frames[index]
+        self.frame_timestamp = time.monotonic()
+        self.frame_seq += 1
+        return self.frame
+
+    def get_next_index(self):
+        index = self.index + 1
+        if index >= len(self.records):
+            if not self.loop:
+                return None
+            index = 0
+
+        if self.rate == 'max':
+            return index
+
+        now = time.monotonic()
+        if self.rate == 'realtime':
+            if self.start_time is None or index == 0:
+                # Start (or start over) the recording's clock at this frame
+                self.start_time = now - (self.timestamps[index] - self.timestamps[0])
+
+            if self.drop_late:
+                # Skip to the newest frame that was already captured by now on the recording's clock
+                recording_now = self.timestamps[0] + now - self.start_time
+                index = max(index, int(np.searchsorted(self.timestamps, recording_now, side='right')) - 1)
+
+            due_time = self.start_time + self.timestamps[index] - self.timestamps[0]
+        else:
+            due_time = now if self.next_time is None else self.next_time
+            self.next_time = max(due_time, now) + 1.0 / float(self.rate)
+
+        # Wait until the frame is due
+        if due_time > now:
+            time.sleep(due_time - now)
+        return index
+
+    def get_frame_info(self):
+        '''Returns (frame, capture timestamp, sequence number) of the last frame returned by get_frame()'''
+        return self.frame, self.frame_timestamp, self.frame_seq
+
+    def get_recorded_info(self):
+        '''Returns (recorded capture timestamp, recorded frame seq) of the last frame returned by get_frame()'''
+        if self.index < 0:
+            return None, None
+        return float(self.timestamps[self.index]), int(self.records['seq'][self.index])
@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class ResultBus:
+    '''
+    Publish/subscribe for pipeline results. Pipelines publish() after every process() call, and consumers (the
+    telemetry socket, UDP, HTTP streams, logging) either block in wait_for_next() until there's something new or read
+    latest() without waiting. Nobody has to poll.
+
+    Every publish() gets the next bus sequence number, so a consumer only has to remember the last seq it handled.
+    Results of all pipelines share the one sequence, and each result holds the newest result of every pipeline
+    (ie. the turret values next to the intake values), since that's what gets sent to the robot.
+    '''
+
+    def __init__(self, names=()):
+        '''
+        names -- pipeline names that should show up in results before they have published anything (as None)
+        '''
+        self.condition = threading.Condition()
+        self.seq = 0
+        self.source = None  # name of the pipeline that published last
+        self.results = {name: None for name in names}  # name -> (frame_seq, capture_time, done_time, values)
+
+        self.listeners = []  # functions called (from the publishing thread) after every publish
+
+    def publish(self, name, values, frame_seq=0, capture_time=None, done_time=None, snapshot=None):
+        '''
+        name -- pipeline name (ie. 'turret')
+        values -- output values tuple of the pipeline
+        frame_seq, capture_time -- of the frame these values came from, if the source knows
+        done_time -- time.monotonic() when the pipeline finished, None for now
+        snapshot -- FrameSnapshot the values came from, for the listeners (ie. to stream its output frames)
+
+        Returns the bus seq of this result.
+        '''
+        if done_time is None:
+            done_time = time.monotonic()
+
+        with self.condition:
+            self.seq += 1
+            self.source = name
+            self.results[name] = (frame_seq, capture_time, done_time, tuple(values))
+            seq = self.seq
+            self.condition.notify_all()
+
+        for listener in list(self.listeners):
+            listener(name, snapshot)
+
+        return seq
+
+    def add_listener(self, listener):
+        '''
+        listener -- function(name, snapshot) called from the publishing thread, so it should be quick
+            (ie. hand the snapshot off to a StreamHub)
+        '''
+        self.listeners.append(listener)
+
+    def latest(self):
+        '''Returns (seq, source name, dict of name -> result) without waiting'''
+        with self.condition:
+            return self.seq, self.source, dict(self.results)
+
+    def wait_for_next(self, after_seq=0, timeout=None):
+        '''
+        Blocks until a result newer than after_seq is published, then returns latest().
+        Returns (after_seq, None, None) on timeout.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq > after_seq, timeout):
+                return after_seq, None, None
+            return self.seq, self.source, dict(self.results)
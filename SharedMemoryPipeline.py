@@ -0,0 +1,352 @@
+import atexit
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import threading
+import time
+import os
+import logging
+import cv2
+import numpy as np
+from Snapshot import FrameSnapshot
+
+
+class SharedFrameRing:
+    '''
+    Ring of fixed-shape frames in shared memory, written by one process and read by others without copying.
+    The writer always fills a slot that no reader is using, and readers claim the newest frame until they release it.
+
+    shape -- shape of every frame (ie. (480, 640, 3)). Frames of another size are resized on write.
+    slots -- number of frames in the ring. Needs to be at least 2 more than the number of frames claimed at once.
+    context -- multiprocessing context the readers and writer are started from
+    '''
+
+    def __init__(self, shape, context, slots=4, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        header_bytes = 64 * (slots + 1)  # keeps the frames 64 byte aligned
+
+        self.shm = shared_memory.SharedMemory(create=True, size=header_bytes + frame_bytes * slots)
+        self.condition = context.Condition()
+
+        # Header: per slot sequence number, reader count and capture timestamp, then [slot index, seq] of the newest frame
+        self.seqs = np.ndarray((slots, ), dtype=np.int64, buffer=self.shm.buf, offset=0)
+        self.claims = np.ndarray((slots, ), dtype=np.int64, buffer=self.shm.buf, offset=8 * slots)
+        self.timestamps = np.ndarray((slots, ), dtype=np.float64, buffer=self.shm.buf, offset=16 * slots)
+        self.latest = np.ndarray((2, ), dtype=np.int64, buffer=self.shm.buf, offset=24 * slots)
+        self.frames = np.ndarray((slots, ) + self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=header_bytes)
+
+        self.seqs[:] = 0
+        self.claims[:] = 0
+        self.timestamps[:] = 0
+        self.latest[:] = (-1, 0)
+
+    def write(self, frame, seq, timestamp):
+        '''Copies the frame into a free slot and makes it the newest. Returns False if every slot is claimed.'''
+        with self.condition:
+            index = self.get_free_slot()
+        if index is None:
+            return False
+
+        # Nobody can claim this slot until it's the newest, so copy outside of the lock
+        if frame.shape == self.shape:
+            np.copyto(self.frames[index], frame)
+        else:
+            cv2.resize(frame, (self.shape[1], self.shape[0]), dst=self.frames[index])
+
+        with self.condition:
+            self.seqs[index] = seq
+            self.timestamps[index] = timestamp
+            self.latest[:] = (index, seq)
+            self.condition.notify_all()
+
+        return True
+
+    def get_free_slot(self):
+        for index in range(self.slots):
+            if self.claims[index] == 0 and index != self.latest[0]:
+                return index
+        return None
+
+    def claim_latest(self, after_seq=0, timeout=None):
+        '''
+        Waits (up to timeout seconds) for a frame newer than after_seq and claims it so it won't be overwritten.
+        Returns (slot index, frame view, seq, timestamp), or None on timeout. Call release(slot index) when done.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latest[1] > after_seq, timeout):
+                return None
+
+            index = int(self.latest[0])
+            self.claims[index] += 1
+            return index, self.frames[index], int(self.seqs[index]), float(self.timestamps[index])
+
+    def release(self, index):
+        with self.condition:
+            self.claims[index] -= 1
+
+    def close(self, unlink=False):
+        # The NumPy views have to go before the shared memory can be closed
+        self.seqs = self.claims = self.timestamps = self.latest = self.frames = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class SharedResultSlot:
+    '''
+    The newest output values of a pipeline in shared memory, with the seq and timestamps of the frame they came from.
+
+    template -- output values tuple of the pipeline (ie. (False, 0, 0)). bools stay bools, everything else is a float.
+    '''
+
+    def __init__(self, template, context):
+        self.types = [bool if isinstance(value, bool) else float for value in template]
+
+        self.shm = shared_memory.SharedMemory(create=True, size=8 * (4 + len(self.types)))
+        self.condition = context.Condition()
+
+        # [result seq, frame seq, capture time, done time, values...]
+        self.data = np.ndarray((4 + len(self.types), ), dtype=np.float64, buffer=self.shm.buf)
+        self.data[:] = 0
+        self.data[4:] = template
+
+    def publish(self, values, frame_seq, capture_time, done_time):
+        with self.condition:
+            self.data[0] += 1
+            self.data[1:4] = (frame_seq, capture_time, done_time)
+            self.data[4:] = values
+            self.condition.notify_all()
+
+    def read(self):
+        '''Returns (result seq, frame seq, capture time, done time, values)'''
+        with self.condition:
+            data = self.data.tolist()
+
+        values = tuple(value_type(value) for value_type, value in zip(self.types, data[4:]))
+        return int(data[0]), int(data[1]), data[2], data[3], values
+
+    def wait_for_next(self, after_seq=0, timeout=None):
+        '''Waits (up to timeout seconds) for a result newer than after_seq and returns read(), or None on timeout'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.data[0] > after_seq, timeout):
+                return None
+        return self.read()
+
+    def close(self, unlink=False):
+        self.data = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ProcessPipeline:
+    '''
+    Runs a camera's capture and vision pipeline in two separate worker processes, so they don't share the GIL with
+    each other or with the streaming and socket threads. Frames go from the capture process to the pipeline process
+    through a SharedFrameRing, and the output values and frames come back through a SharedResultSlot and one
+    SharedFrameRing per output stream.
+
+    Has the same get_output_values(), get_output_frames() and get_snapshot() as the pipeline it wraps, so it can be streamed and sent
+    over the socket like one. Output frames are only sent back for the streams passed to set_watched().
+
+    Processes are forked (Linux only), so create and start these before starting any threads.
+    '''
+
+    def __init__(self, name, make_source, pipeline, frame_shape, output_shapes, target_fps=None, niceness=0,
+                 on_result=None):
+        '''
+        name -- str used for logging and process names (ie. 'turret')
+        make_source -- function that returns the image Source object. Called in the capture process, so camera threads
+            and handles only live there.
+        pipeline -- pipeline object as specified by GenericPipeline, copied into the pipeline process
+        frame_shape -- shape of the camera frames (ie. (480, 640, 3))
+        output_shapes -- dict of output stream name -> frame shape (ie. {'mask': (480, 640), 'final': (480, 640, 3)})
+        target_fps -- max frames per second the pipeline process handles, None for as fast as frames come in
+        niceness -- added to the nice value of both processes, to give this camera a lower priority
+        on_result -- function(ProcessPipeline) called in this process after every new result
+        '''
+        self.name = name
+        self.on_result = on_result
+
+        context = multiprocessing.get_context('fork')
+
+        self.frame_ring = SharedFrameRing(frame_shape, context)
+        self.output_rings = {stream: SharedFrameRing(shape, context) for stream, shape in output_shapes.items()}
+        self.result_slot = SharedResultSlot(pipeline.get_output_values(), context)
+        self.stop_event = context.Event()
+
+        # One flag per output stream, set while someone watches it. The pipeline process only renders and writes those.
+        self.stream_names = list(output_shapes)
+        self.watched = context.RawArray('b', len(self.stream_names))
+
+        self.processes = [
+            context.Process(target=run_capture_process, name=name + '-capture', daemon=True,
+                            args=(make_source, self.frame_ring, self.stop_event, niceness)),
+            context.Process(target=run_pipeline_process, name=name + '-pipeline', daemon=True,
+                            args=(pipeline, self.frame_ring, self.output_rings, self.watched, self.result_slot,
+                                  self.stop_event, target_fps, niceness)),
+        ]
+
+        # Last result read in this process
+        self.result_seq = 0
+        self.frame_seq = 0
+        self.capture_time = None
+        self.done_time = None
+        self.output_data = tuple(pipeline.get_output_values())
+        self.snapshot = FrameSnapshot(0, self.output_data, [(name, None) for name in output_shapes])
+
+        self.frame_times = collections.deque(maxlen=30)  # done times of the last results, for the FPS
+        self.listener_thread = None
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+        atexit.register(self.stop)
+
+    # Starts the thread that reads results in this process. Call after every ProcessPipeline has been started, since
+    # forking with other threads running isn't safe.
+    def start_listener(self):
+        self.listener_thread = threading.Thread(target=self.listen, name=self.name + '-results', daemon=True)
+        self.listener_thread.start()
+
+    def stop(self):
+        if self.stop_event.is_set():
+            return
+
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+
+        for ring in [self.frame_ring] + list(self.output_rings.values()):
+            ring.close(unlink=True)
+        self.result_slot.close(unlink=True)
+
+    # Used in thread
+    def listen(self):
+        while not self.stop_event.is_set():
+            result = self.result_slot.wait_for_next(self.result_seq, timeout=0.5)
+            if result is None:
+                continue
+
+            self.result_seq, self.frame_seq, self.capture_time, self.done_time, self.output_data = result
+            self.frame_times.append(self.done_time)
+
+            # Output frames of the same frame as the values, copied out of shared memory
+            self.snapshot = FrameSnapshot(self.frame_seq, self.output_data, self.read_output_frames(self.frame_seq),
+                                          self.capture_time, self.done_time)
+
+            if self.on_result is not None:
+                self.on_result(self)
+
+    def get_output_values(self):
+        return self.snapshot.get_output_values()
+
+    def get_output_frames(self):
+        return self.snapshot.get_output_frames()
+
+    def get_snapshot(self):
+        return self.snapshot
+
+    def set_watched(self, names):
+        '''names -- output streams someone is watching, the others aren't rendered or copied anymore'''
+        for i, name in enumerate(self.stream_names):
+            self.watched[i] = name in names
+
+    def read_output_frames(self, frame_seq):
+        # Copy the output frames of frame_seq out of shared memory, since the pipeline process reuses the slots.
+        # A stream without that frame (ie. the pipeline didn't output it, or nobody watches it) is None.
+        output_frames = []
+        for i, (name, ring) in enumerate(self.output_rings.items()):
+            frame = None
+
+            claimed = ring.claim_latest(frame_seq - 1, timeout=0) if self.watched[i] else None
+            if claimed is not None:
+                index, view, seq, _ = claimed
+                if seq == frame_seq:
+                    frame = np.copy(view)
+                ring.release(index)
+
+            output_frames.append((name, frame))
+
+        return output_frames
+
+    def get_fps(self):
+        frame_times = list(self.frame_times)
+        if len(frame_times) < 2:
+            return 0.0
+
+        return (len(frame_times) - 1) / (time.monotonic() - frame_times[0])
+
+
+# Runs in the capture process
+def run_capture_process(make_source, frame_ring, stop_event, niceness=0):
+    if niceness > 0:
+        os.nice(niceness)
+
+    source = make_source()
+    seq = 0
+
+    try:
+        while not stop_event.is_set():
+            frame = source.get_frame()
+            if frame is None:  # camera not ready yet
+                time.sleep(0.01)
+                continue
+
+            if hasattr(source, 'get_frame_info'):
+                _, timestamp, seq = source.get_frame_info()
+            else:
+                timestamp, seq = time.monotonic(), seq + 1
+
+            if not frame_ring.write(frame, seq, timestamp):
+                logging.info('Dropped a frame, every slot of the frame ring is in use')
+    finally:
+        # atexit doesn't run in child processes, so stop the source (ie. flush a RecordingSource) here
+        if hasattr(source, 'stop'):
+            source.stop()
+
+
+# Runs in the pipeline process
+def run_pipeline_process(pipeline, frame_ring, output_rings, watched, result_slot, stop_event, target_fps=None,
+                         niceness=0):
+    if niceness > 0:
+        os.nice(niceness)
+
+    period = 1.0 / target_fps if target_fps else 0
+    seq = 0
+
+    while not stop_event.is_set():
+        start_time = time.monotonic()
+
+        # Process the newest frame right where it is in shared memory
+        claimed = frame_ring.claim_latest(seq, timeout=0.5)
+        if claimed is None:
+            continue
+
+        index, frame, seq, capture_time = claimed
+        try:
+            pipeline.process(frame)
+
+            # The snapshot's frames can still point into the frame ring, so copy them out before releasing the slot.
+            # Only the watched streams are rendered (see FrameSnapshot.get_frame()).
+            snapshot = pipeline.get_snapshot()
+            for i, (name, ring) in enumerate(output_rings.items()):
+                output_frame = snapshot.get_frame(name) if watched[i] else None
+                if output_frame is not None:
+                    ring.write(output_frame, seq, capture_time)
+        finally:
+            frame_ring.release(index)
+
+        result_slot.publish(snapshot.get_output_values(), seq, capture_time, time.monotonic())
+
+        # Stay under the target FPS
+        remaining = period - (time.monotonic() - start_time)
+        if remaining > 0:
+            time.sleep(remaining)
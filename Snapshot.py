@@ -0,0 +1,97 @@
+import threading
+import time
+
+
+class FrameSnapshot:
+    '''
+    Everything a pipeline produced for one frame: the output values and output frames (ie. 'mask' and 'final'), with
+    the id and timestamps of the frame they came from. A snapshot never changes after it's created, and its frames are
+    read-only views, so any thread can read the values and frames of one snapshot together without locks or copies.
+
+    Output frames can also be given as functions that render them (ie. the annotated debug frame). Those only run the
+    first time someone asks for the frame, so nothing is drawn while nobody is watching the stream.
+    '''
+
+    def __init__(self, frame_id, values, frames, capture_time=None, done_time=None):
+        '''
+        frame_id -- sequence number of the frame (from the source), 0 if unknown
+        values -- output values tuple
+        frames -- list of (name, frame) of the output frames, in the order of get_output_frames(). A frame can be an
+            array (that the pipeline won't write to anymore), a function() that returns one, or None.
+        capture_time -- time.monotonic() when the frame was captured, if known
+        done_time -- time.monotonic() when the pipeline finished, None for now
+        '''
+        self.frame_id = frame_id
+        self.values = tuple(values)
+        self.names = tuple(name for name, _ in frames)
+        self.capture_time = capture_time
+        self.done_time = time.monotonic() if done_time is None else done_time
+
+        self.frames = {}  # name -> read-only frame, filled in as they are rendered
+        self.renderers = {}  # name -> function that renders the frame
+        for name, frame in frames:
+            if callable(frame):
+                self.renderers[name] = frame
+            else:
+                self.frames[name] = read_only(frame)
+
+        self.render_lock = threading.Lock()
+
+    def get_output_values(self):
+        return self.values
+
+    def get_output_names(self):
+        return list(self.names)
+
+    def get_output_frames(self):
+        '''Returns every output frame (rendering the ones that weren't yet) as from a pipeline's get_output_frames()'''
+        return [{'name': name, 'frame': self.get_frame(name)} for name in self.names]
+
+    def get_frame(self, name):
+        '''Returns the output frame called name, rendering it if this is the first time. None if there is none.'''
+        if name in self.frames:
+            return self.frames[name]
+        if name not in self.renderers:
+            return None
+
+        # Several stream clients can ask at once, only render once
+        with self.render_lock:
+            if name not in self.frames:
+                self.frames[name] = read_only(self.renderers[name]())
+            return self.frames[name]
+
+
+class SnapshotBuffer:
+    '''
+    The last few snapshots of a pipeline (3 by default: the newest one that readers pick up, the one before it that a
+    slow reader may still be using, and the one being retired). The pipeline thread publish()es by swapping a single
+    reference, so readers always get the newest complete snapshot with latest() and never a mix of two frames.
+
+    publish() returns the snapshot that just dropped out of the buffer. Readers may still be holding on to it, so its
+    arrays can only be reused once it's gone (ie. with weakref.finalize()).
+    '''
+
+    def __init__(self, initial, count=3):
+        '''initial -- FrameSnapshot returned by latest() until the first publish()'''
+        self.count = count
+        self.snapshots = (initial, )  # newest first, replaced as a whole on every publish()
+
+    def publish(self, snapshot):
+        '''Makes snapshot the newest. Returns the snapshot that fell out of the buffer, or None. Writer thread only.'''
+        snapshots = (snapshot, ) + self.snapshots
+        retired = snapshots[self.count] if len(snapshots) > self.count else None
+
+        self.snapshots = snapshots[:self.count]  # the swap, a single reference assignment
+        return retired
+
+    def latest(self):
+        return self.snapshots[0]
+
+
+def read_only(frame):
+    if frame is None:
+        return None
+
+    view = frame.view()
+    view.flags.writeable = False
+    return view
@@ -0,0 +1,144 @@
+import collections
+import threading
+import time
+import logging
+
+
+class FrameContext:
+    '''
+    Everything a pipeline's stages know about one frame. Each stage adds its results as attributes for the next stages.
+    '''
+
+    def __init__(self, frame, frame_seq=None, capture_time=None):
+        self.frame = frame
+        self.frame_seq = frame_seq
+        self.capture_time = capture_time
+        self.stage_times = []  # (stage name, start time, end time) of every stage run so far, see LatencyStats
+
+    def run(self, stage):
+        '''Runs stage on this frame, recording when it started and ended'''
+        start = time.monotonic()
+        stage(self)
+        self.stage_times.append((stage.__name__, start, time.monotonic()))
+
+
+class DropOldestQueue:
+    '''Bounded queue between two stages. When it's full, putting a new item drops the oldest one.'''
+
+    def __init__(self, maxsize=1, on_drop=None):
+        '''on_drop -- function(item) called with every item that is dropped, None to just forget them'''
+        self.items = collections.deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.on_drop = on_drop
+
+    def put(self, item):
+        dropped = None
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+                dropped = self.items[0]
+            self.items.append(item)
+            self.condition.notify()
+
+        # Outside of the condition, so the stage threads don't wait on it
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self, timeout=None):
+        '''Returns the oldest item, or None if nothing comes in within timeout seconds'''
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                return None
+            return self.items.popleft()
+
+
+class StagedPipeline:
+    '''
+    Runs a pipeline that is split into stages (see get_stages() of Turret and Intake).
+
+    Pipelined, every stage runs on its own thread and hands frames to the next stage through a bounded DropOldestQueue,
+    so frame N + 1 can be thresholded while frame N is being filtered and drawn. Throughput then approaches that of the
+    slowest stage instead of the sum of all stages, and process() returns right away.
+
+    Serial (pipelined=False), process() just runs every stage in order like the pipeline's own process() (for debugging).
+    '''
+
+    def __init__(self, pipeline, pipelined=True, queue_size=1, on_result=None, name='pipeline'):
+        '''
+        pipeline -- pipeline object with a get_stages() function
+        queue_size -- frames that can wait in front of each stage before the oldest is dropped
+        on_result -- function(FrameContext) called after the last stage of every frame
+
+        Frames that are dropped (or whose stage fails) are passed to the pipeline's drop_frame(ctx), if it has one, so
+        it can take back the buffers they hold.
+        '''
+        self.pipeline = pipeline
+        self.stages = pipeline.get_stages()
+        self.pipelined = pipelined
+        self.on_result = on_result
+        self.name = name
+
+        self.queues = [DropOldestQueue(queue_size, self.drop) for _ in self.stages]
+        self.threads = []
+        self.running = False
+
+    def start(self):
+        if not self.pipelined or self.running:
+            return
+
+        self.running = True
+        for i in range(len(self.stages)):
+            thread = threading.Thread(target=self.run_stage, args=(i, ), name=self.name + '-stage' + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def process(self, frame, frame_seq=None, capture_time=None):
+        ctx = FrameContext(frame, frame_seq, capture_time)
+
+        if not self.pipelined:
+            for stage in self.stages:
+                ctx.run(stage)
+            self.finish(ctx)
+        else:
+            self.queues[0].put(ctx)
+
+    def finish(self, ctx):
+        if self.on_result is not None:
+            self.on_result(ctx)
+
+    def drop(self, ctx):
+        if hasattr(self.pipeline, 'drop_frame'):
+            self.pipeline.drop_frame(ctx)
+
+    # Used in thread
+    def run_stage(self, i):
+        stage = self.stages[i]
+        is_last = i == len(self.stages) - 1
+
+        while self.running:
+            ctx = self.queues[i].get(timeout=0.5)
+            if ctx is None:
+                continue
+
+            try:
+                ctx.run(stage)
+            except Exception:
+                logging.exception('%s stage %s failed, dropping the frame', self.name, stage.__name__)
+                self.drop(ctx)
+                continue
+
+            if is_last:
+                self.finish(ctx)
+            else:
+                self.queues[i + 1].put(ctx)
+
+    def get_dropped(self):
+        '''Returns how many frames were dropped in front of each stage'''
+        return [queue.dropped for queue in self.queues]
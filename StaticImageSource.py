@@ -1,4 +1,5 @@
 import cv2
+import time
 
 
 class StaticImageSource:
@@ -7,8 +8,16 @@ class StaticImageSource:
         self.image_path = image_path
         self.frame = None  # the image frame, pre-allocated to save memory
 
+        # Metadata of the last frame returned by get_frame()
+        self.frame_timestamp = None
+        self.frame_seq = 0
+
     def get_frame(self):
         self.frame = cv2.imread(cv2.samples.findFile(self.image_path))
+        self.frame_timestamp = time.monotonic()
+        self.frame_seq += 1
         return self.frame
 
-
+    def get_frame_info(self):
+        '''Returns (frame, capture timestamp, sequence number) of the last frame returned by get_frame()'''
+        return self.frame, self.frame_timestamp, self.frame_seq
@@ -0,0 +1,294 @@
+import threading
+import time
+from urllib.parse import parse_qs
+import logging
+import cv2
+import numpy as np
+
+
+class FrameStream:
+    '''
+    Latest frame of a single output stream (ie. 'mask' or 'final'). The frame is JPEG-encoded at most once per variant
+    (width and quality), by whichever client asks for that variant first, and then shared by every client that wants
+    the same one.
+
+    A frame can also be published as a function that renders it, which is then only called when a client asks for the
+    frame, so at the rate of the fastest client. Clients subscribe() while they are watching so the pipeline can tell
+    whether the stream is watched at all (see has_subscribers()).
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.condition = threading.Condition()
+        self.encode_lock = threading.Lock()  # held while encoding so that only one client encodes each frame
+
+        self.seq = 0  # increases by one every time the pipeline publishes a new frame
+        self.frame = None  # newest raw frame
+        self.jpeg = None  # bytes of frame number jpeg_seq if it was published already encoded (see publish_jpeg())
+        self.jpeg_seq = 0
+
+        # Encoder cache: (width, quality) -> (seq, jpeg bytes) of the newest frame encoded that way, None for the
+        # frame's own width and the default quality
+        self.variants = {}
+        self.rendered = None  # (seq, frame) last rendered or decoded for an encode, shared by every variant
+
+        self.listeners = []  # functions called (from the publishing thread) whenever a new frame is published
+        self.subscribers = 0  # clients currently watching, changed under the condition
+
+    def publish(self, frame):
+        '''frame -- the new frame, a function() that renders it, or None if there's none to show'''
+        with self.condition:
+            self.seq += 1
+            self.frame = frame
+            self.condition.notify_all()
+
+        for listener in list(self.listeners):
+            listener()
+
+    def publish_jpeg(self, jpeg):
+        '''Publishes a frame that is already JPEG-encoded (ie. straight from the camera), it's sent as is'''
+        with self.condition:
+            self.seq += 1
+            self.frame = None
+            self.jpeg = jpeg
+            self.jpeg_seq = self.seq
+            self.condition.notify_all()
+
+        for listener in list(self.listeners):
+            listener()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def subscribe(self):
+        with self.condition:
+            self.subscribers += 1
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def has_subscribers(self):
+        return self.subscribers > 0
+
+    def wait_for_jpeg(self, after_seq=0, timeout=None, width=None, quality=None):
+        '''
+        Blocks until a frame newer than after_seq is published, then returns (seq, jpeg bytes).
+        Returns (after_seq, None) on timeout.
+
+        width -- to scale the frame down to (keeping its aspect ratio), None for its own size
+        quality -- JPEG quality from 1 to 100, None for OpenCV's default (95)
+        '''
+        with self.condition:
+            ready = lambda: self.seq > after_seq and (self.frame is not None or self.jpeg_seq == self.seq)
+            if not self.condition.wait_for(ready, timeout):
+                return after_seq, None
+
+            seq, frame = self.seq, self.frame
+            jpeg = self.jpeg if self.jpeg_seq == seq else None
+
+            # Published already encoded, sent as is unless the client wants it smaller
+            if jpeg is not None and width is None and quality is None:
+                return seq, jpeg
+
+        # Encode outside of the condition so the pipeline thread never waits on a JPEG encode
+        with self.encode_lock:
+            # Another client may already have encoded this frame (or a newer one) the same way
+            variant_seq, variant = self.variants.get((width, quality), (0, None))
+            if variant_seq >= seq:
+                return variant_seq, variant
+
+            if callable(frame) or frame is None:
+                if self.rendered is not None and self.rendered[0] == seq:
+                    frame = self.rendered[1]
+                else:
+                    frame = frame() if callable(frame) else cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8),
+                                                                         cv2.IMREAD_UNCHANGED)
+                    self.rendered = (seq, frame)
+            if frame is None:
+                return seq, None  # nothing was rendered for this one (ie. the stream wasn't watched yet)
+
+            variant = encode_jpeg(frame, width, quality)
+            self.variants[(width, quality)] = (seq, variant)
+
+            # Forget the variants nobody asked for in a while (ie. that client left)
+            for key in [key for key, (variant_seq, _) in self.variants.items() if variant_seq < seq - 100]:
+                del self.variants[key]
+
+            return seq, variant
+
+
+class BandwidthBudget:
+    '''
+    Keeps the streams of every hub that shares it under a total number of bytes per second (ie. the FRC field's
+    bandwidth limit). Handlers report what they sent with add(), and once a second the JPEG quality of every stream is
+    scaled down when the total went over the budget, and back up again when it's well under.
+    '''
+
+    def __init__(self, bytes_per_second, min_quality=10, default_quality=95, interval=1.0):
+        '''
+        bytes_per_second -- budget of all streams together
+        min_quality -- quality is never lowered below this
+        default_quality -- quality of clients that didn't ask for one (OpenCV's default)
+        interval -- seconds the sent bytes are summed over before the quality is adjusted
+        '''
+        self.bytes_per_second = bytes_per_second
+        self.min_quality = min_quality
+        self.default_quality = default_quality
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.scale = 1.0  # of the quality clients ask for
+        self.rate = 0.0  # bytes per second over the last interval
+        self.sent = 0
+        self.start_time = time.monotonic()
+
+    def add(self, sent_bytes):
+        with self.lock:
+            self.sent += sent_bytes
+            self.update()
+
+    def update(self):
+        '''Adjusts the scale if an interval went by (called from add() and get_quality(), under the lock)'''
+        now = time.monotonic()
+        elapsed = now - self.start_time
+        if elapsed < self.interval:
+            return
+
+        self.rate = self.sent / elapsed
+        self.sent = 0
+        self.start_time = now
+
+        # Never below what gives the default quality min_quality, so it doesn't take minutes to come back up
+        scale = self.scale
+        min_scale = self.min_quality / self.default_quality
+        if self.rate > self.bytes_per_second:
+            scale = max(min_scale, scale * 0.9 * self.bytes_per_second / self.rate)
+        elif self.rate < 0.7 * self.bytes_per_second and scale < 1.0:
+            # Once per interval that went by, also the ones where nothing was sent at all. 50 intervals already get it
+            # from the floor back to 1 (and hours of them would overflow).
+            scale = min(1.0, scale * 1.1 ** min(elapsed / self.interval, 50))
+
+        if scale != self.scale:
+            logging.debug('Streams at %.0f of %.0f bytes/s, quality scaled to %.2f', self.rate,
+                          self.bytes_per_second, scale)
+        self.scale = scale
+
+    def get_quality(self, quality=None):
+        '''Returns the quality to encode with for a client that asked for quality (None for the default)'''
+        with self.lock:
+            self.update()
+
+        if self.scale >= 1.0:
+            return quality
+
+        quality = self.default_quality if quality is None else quality
+        # In steps of 5, so clients that asked for about the same quality still share an encode
+        return max(self.min_quality, int(quality * self.scale) // 5 * 5)
+
+
+class StreamHub:
+    '''
+    Fans the output frames of one pipeline out to any number of HTTP clients. Streams are keyed by output name.
+    The pipeline thread calls publish_snapshot() after each process() call; client handlers subscribe() to a stream,
+    call wait_for_jpeg() and report what they sent with add_sent().
+    '''
+
+    def __init__(self, budget=None):
+        '''budget -- BandwidthBudget shared with the other hubs, None for no limit'''
+        self.budget = budget
+        self.streams = {}
+        self.jpeg_names = []  # streams of frames published already encoded, that no pipeline outputs
+        self.lock = threading.Lock()
+
+    def get_stream(self, name):
+        with self.lock:
+            if name not in self.streams:
+                self.streams[name] = FrameStream(name)
+            return self.streams[name]
+
+    def publish(self, name, frame):
+        self.get_stream(name).publish(frame)
+
+    def publish_snapshot(self, snapshot):
+        '''
+        Publishes the output frames of a FrameSnapshot, but only to streams that someone is watching, and only as
+        functions so that a frame is rendered (see FrameSnapshot.get_frame()) when a client actually asks for it.
+        '''
+        for name in snapshot.get_output_names():
+            stream = self.get_stream(name)
+            if stream.has_subscribers():
+                stream.publish(lambda name=name: snapshot.get_frame(name))
+            elif stream.frame is not None:
+                stream.publish(None)  # so a new client doesn't get a stale frame
+
+    def publish_jpeg(self, name, jpeg):
+        '''
+        Publishes JPEG bytes (or a uint8 array of them) as the newest frame of stream name (ie. the camera's own
+        MJPEG), if anyone watches it. Only then is an array copied to bytes.
+        '''
+        stream = self.get_stream(name)
+        if name not in self.jpeg_names:
+            with self.lock:
+                self.jpeg_names.append(name)
+
+        if stream.has_subscribers():
+            stream.publish_jpeg(bytes(jpeg))
+
+    def get_jpeg_names(self):
+        '''Returns the names of the streams publish_jpeg() was called for, to serve next to the pipeline's outputs'''
+        with self.lock:
+            return list(self.jpeg_names)
+
+    def subscribe(self, name):
+        self.get_stream(name).subscribe()
+
+    def unsubscribe(self, name):
+        self.get_stream(name).unsubscribe()
+
+    def get_watched_names(self):
+        '''Returns the names of the streams that have subscribers'''
+        with self.lock:
+            return [name for name, stream in self.streams.items() if stream.has_subscribers()]
+
+    def wait_for_jpeg(self, name, after_seq=0, timeout=None, width=None, quality=None):
+        '''See FrameStream.wait_for_jpeg(). The quality is lowered while the streams are over the bandwidth budget.'''
+        if self.budget is not None:
+            quality = self.budget.get_quality(quality)
+        return self.get_stream(name).wait_for_jpeg(after_seq, timeout, width, quality)
+
+    def add_sent(self, sent_bytes):
+        '''Call with the size of every frame sent to a client'''
+        if self.budget is not None:
+            self.budget.add(sent_bytes)
+
+
+def encode_jpeg(frame, width=None, quality=None):
+    if width is not None and width < frame.shape[1]:
+        height = max(1, round(frame.shape[0] * width / frame.shape[1]))
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality is not None else []
+    return cv2.imencode('.jpg', frame, params)[1].tobytes()
+
+
+def parse_stream_options(query):
+    '''
+    Returns (width, quality, fps) from the query string of a stream URL (ie. 'w=160&q=40&fps=10' of
+    final.mjpg?w=160&q=40&fps=10), each None when it's missing or invalid.
+    '''
+    params = parse_qs(query)
+
+    def get(key, convert, low, high):
+        try:
+            value = convert(params[key][0])
+        except (KeyError, ValueError):
+            return None
+        if value != value:  # NaN
+            return None
+        return min(max(value, low), high)
+
+    width = get('w', int, 16, 4096)
+    quality = get('q', int, 1, 100)
+    fps = get('fps', float, 0.1, 120.0)
+    return width, quality, fps
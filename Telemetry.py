@@ -0,0 +1,90 @@
+'''
+Vision data sent to the robot, one message per new pipeline result.
+
+Binary format (network byte order, no padding, MESSAGE.size = 74 bytes):
+    magic           2s  b'GV'
+    version         B   VERSION
+    source          B   camera whose new result triggered this message (SOURCE_TURRET or SOURCE_INTAKE)
+    msg_seq         I   counts up by 1 per message, to spot dropped or stale messages
+    send_time       d   time.monotonic() when the message was packed (seconds)
+
+    turret_seq      I   frame sequence number of the turret result (0 if there is none yet)
+    turret_capture  d   time.monotonic() when that frame was captured
+    turret_done     d   time.monotonic() when the pipeline finished with it
+    turret_status   ?   target found
+    turret_theta    d   angle to the target (radians)
+    hub_distance    d   distance to the hub (inches)
+
+    intake_seq      I   same as above, for the intake
+    intake_capture  d
+    intake_done     d
+    ball_detected   ?
+
+The timestamps are from the Jetson's clock, so only differences between them mean anything to the robot
+(ie. send_time - turret_capture is how old the turret values were when they were sent).
+
+Text format (legacy): str() of the turret + intake output values tuple and a newline, ie. "(True, 0.1, 120.5, False)"
+'''
+import struct
+import time
+
+
+MESSAGE = struct.Struct('!2sBBId' 'Idd?dd' 'Idd?')
+MAGIC = b'GV'
+VERSION = 1
+
+SOURCE_TURRET = 0
+SOURCE_INTAKE = 1
+
+# Output values used until a pipeline has its first result
+DEFAULT_TURRET_VALUES = (False, 0, 0)
+DEFAULT_INTAKE_VALUES = (False, )
+
+
+def pack_binary(msg_seq, source, turret_result, intake_result, send_time=None):
+    '''
+    msg_seq -- int, number of this message
+    source -- SOURCE_TURRET or SOURCE_INTAKE
+    turret_result, intake_result -- (frame_seq, capture_time, done_time, output values) of the newest result of each
+        pipeline, or None if it has none yet
+    send_time -- time.monotonic() to send, None for now
+    '''
+    turret_seq, turret_capture, turret_done, turret_values = get_result_fields(turret_result, DEFAULT_TURRET_VALUES)
+    intake_seq, intake_capture, intake_done, intake_values = get_result_fields(intake_result, DEFAULT_INTAKE_VALUES)
+
+    turret_status, turret_theta, hub_distance = turret_values
+    ball_detected, = intake_values
+
+    return MESSAGE.pack(MAGIC, VERSION, source, msg_seq & 0xFFFFFFFF,
+                        time.monotonic() if send_time is None else send_time,
+                        turret_seq & 0xFFFFFFFF, turret_capture, turret_done,
+                        bool(turret_status), float(turret_theta), float(hub_distance),
+                        intake_seq & 0xFFFFFFFF, intake_capture, intake_done, bool(ball_detected))
+
+
+def unpack_binary(data):
+    '''Returns a binary message as a dict of the fields above (ie. for testing or a Python client)'''
+    fields = MESSAGE.unpack(data[:MESSAGE.size])
+    if fields[0] != MAGIC or fields[1] != VERSION:
+        raise ValueError('Not a version ' + str(VERSION) + ' vision message')
+
+    names = ('magic', 'version', 'source', 'msg_seq', 'send_time',
+             'turret_seq', 'turret_capture', 'turret_done', 'turret_status', 'turret_theta', 'hub_distance',
+             'intake_seq', 'intake_capture', 'intake_done', 'ball_detected')
+    return dict(zip(names, fields))
+
+
+def pack_text(turret_result, intake_result):
+    '''Returns the legacy text message, the same as it was sent before the binary format'''
+    turret_values = get_result_fields(turret_result, DEFAULT_TURRET_VALUES)[3]
+    intake_values = get_result_fields(intake_result, DEFAULT_INTAKE_VALUES)[3]
+
+    return bytes(str(tuple(turret_values) + tuple(intake_values)) + "\n", "UTF-8")
+
+
+def get_result_fields(result, default_values):
+    if result is None:
+        return 0, 0.0, 0.0, default_values
+
+    frame_seq, capture_time, done_time, values = result
+    return int(frame_seq), float(capture_time or 0.0), float(done_time or 0.0), values
@@ -0,0 +1,193 @@
+import selectors
+import socket
+import threading
+import logging
+
+
+class TelemetryServer:
+    '''
+    Non-blocking TCP server that sends the vision data to any number of clients (ie. the robot and a laptop).
+
+    One listening socket is kept for the whole process (with SO_REUSEADDR, so it can be bound again right after a
+    restart), and all sockets are handled from a single thread with selectors. broadcast() never blocks: messages are
+    queued per client, and a client that falls more than max_buffered bytes behind is dropped instead of holding back
+    the others. When the robot resets, its new connection is accepted right away and gets the newest message first.
+    '''
+
+    def __init__(self, address, port, max_buffered=64 * 1024, name='telemetry'):
+        '''
+        address, port -- where to listen ('' for all interfaces)
+        max_buffered -- bytes a client can have waiting to be sent before it's dropped as too slow
+        '''
+        self.address = address
+        self.port = port
+        self.max_buffered = max_buffered
+        self.name = name
+
+        self.selector = selectors.DefaultSelector()
+        self.listener = None
+
+        # Wakes the server thread up from select() when broadcast() queued something
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+
+        # Client socket -> bytearray of data not sent yet, only changed under the lock
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.last_message = None  # sent to new clients first
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.address, self.port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+
+        logging.info('Telemetry server listening on port %d', self.port)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.name + '-server', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        for sock in list(self.clients):
+            self.drop_client(sock)
+        self.selector.close()
+        self.listener.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+    def broadcast(self, message):
+        '''Queues message (bytes) to be sent to every connected client. Safe to call from any thread.'''
+        with self.lock:
+            self.last_message = message
+            for buffer in self.clients.values():
+                buffer += message
+
+        self.wake()
+
+    def get_client_count(self):
+        with self.lock:
+            return len(self.clients)
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # already woken up (or closed)
+
+    # Used in thread
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select(timeout=1.0):
+                sock = key.fileobj
+
+                if sock is self.listener:
+                    self.accept_clients()
+                elif sock is self.wake_reader:
+                    self.drain_wake()
+                else:
+                    if events & selectors.EVENT_READ:
+                        self.read_client(sock)
+                    if events & selectors.EVENT_WRITE and sock in self.clients:
+                        self.send_buffered(sock)
+
+            # Send whatever broadcast() queued since the last time around
+            for sock in list(self.clients):
+                self.send_buffered(sock)
+
+    def accept_clients(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            conn.setblocking(False)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+            with self.lock:
+                self.clients[conn] = bytearray(self.last_message or b'')
+            self.selector.register(conn, selectors.EVENT_READ)
+
+            logging.info('Connected by %s (%d clients)', addr, len(self.clients))
+
+    def drain_wake(self):
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def read_client(self, sock):
+        # Clients don't send anything, so this is just to find out when they disconnect
+        try:
+            data = sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logging.info('Connection lost (%s)', e)
+            self.drop_client(sock)
+            return
+
+        if not data:
+            logging.info('Connection closed by client')
+            self.drop_client(sock)
+
+    def send_buffered(self, sock):
+        with self.lock:
+            buffer = self.clients.get(sock)
+            if buffer is None:
+                return
+
+            if len(buffer) > self.max_buffered:
+                too_slow = True
+            else:
+                too_slow = False
+                try:
+                    sent = sock.send(buffer) if buffer else 0
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                except OSError as e:
+                    logging.info('Connection lost (%s)', e)
+                    sent = None
+                else:
+                    del buffer[:sent]
+
+        if too_slow:
+            logging.info('Dropping a client that is too slow (%d bytes behind)', len(buffer))
+            self.drop_client(sock)
+            return
+
+        if sent is None:
+            self.drop_client(sock)
+            return
+
+        # Only wait to write when the client's socket buffer is full
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if buffer else 0)
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events)
+
+    def drop_client(self, sock):
+        with self.lock:
+            self.clients.pop(sock, None)
+
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
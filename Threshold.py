@@ -0,0 +1,136 @@
+import threading
+import cv2
+import numpy as np
+from BufferPool import BufferPool
+
+
+class HSVThreshold:
+    '''
+    Thresholds BGR frames against one or more HSV ranges (ie. the two wraparound ranges for red) into a single mask.
+
+    use_lut (bool): False to convert to HSV and call cv2.inRange per range (and OR the results).
+        True to look every pixel up in a bit-packed table of all 2^24 BGR colors, compiled from the ranges once per
+        set_ranges() call. This skips the intermediate HSV frame and any extra range checks entirely.
+    '''
+
+    def __init__(self, ranges, use_lut=False, pool=None):
+        '''pool -- BufferPool of the pipeline, to count the allocations of the scratch frames below with'''
+        self.use_lut = use_lut
+        self.pool = BufferPool('threshold') if pool is None else pool
+
+        self.ranges = None
+        self.table = None  # bit-packed BGR -> in range table, only compiled if use_lut
+
+        # Pre-allocated frames/arrays (grown to the largest frame or region thresholded, and sliced down to each one)
+        self.hsv_frame = None
+        self.mask2 = None
+        self.bgra_frame = None
+        self.index = None
+        self.scratch = None
+        self.table_bytes = None
+        self.bit_shifts = None
+
+        self.set_ranges(ranges)
+
+    def set_ranges(self, ranges):
+        '''ranges -- list of (hsv_lower, hsv_upper) pairs. A pixel is in the mask if it is in any of the ranges.'''
+        self.ranges = [(np.array(lower), np.array(upper)) for lower, upper in ranges]
+
+        if self.use_lut:
+            self.table = get_threshold_table(self.ranges)
+
+    def apply(self, frame, dst=None):
+        '''Returns the mask (uint8, 0 or 255) of a BGR frame, written to dst if given (can be a view, ie. a region)'''
+        if self.use_lut:
+            return self.apply_lut(frame, dst)
+
+        h, w = frame.shape[:2]
+        self.hsv_frame = self.pool.fit(self.hsv_frame, (h, w, 3))
+        hsv_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=self.hsv_frame[:h, :w])
+
+        return self.apply_hsv(hsv_frame, dst)
+
+    def apply_hsv(self, hsv_frame, dst=None):
+        '''Same as apply() but with the frame already converted to HSV (ie. shared between several thresholds)'''
+        h, w = hsv_frame.shape[:2]
+
+        lower, upper = self.ranges[0]
+        dst = self.pool.reuse(cv2.inRange(hsv_frame, lower, upper, dst=dst), dst)
+
+        for lower, upper in self.ranges[1:]:
+            self.mask2 = self.pool.fit(self.mask2, (h, w))
+            mask2 = cv2.inRange(hsv_frame, lower, upper, dst=self.mask2[:h, :w])
+            cv2.bitwise_or(dst, mask2, dst=dst)
+
+        return dst
+
+    def apply_lut(self, frame, dst=None):
+        h, w = frame.shape[:2]
+
+        self.bgra_frame = self.pool.fit(self.bgra_frame, (h * w * 4, ))
+        self.index = self.pool.fit(self.index, (h, w), np.uint32)
+        self.scratch = self.pool.fit(self.scratch, (h, w), np.uint32)
+        self.table_bytes = self.pool.fit(self.table_bytes, (h, w))
+        self.bit_shifts = self.pool.fit(self.bit_shifts, (h, w))
+
+        # Flat, so the start of it is a C-contiguous frame that can be viewed as uint32 below (a 2D slice isn't)
+        bgra_frame = self.bgra_frame[:h * w * 4].reshape(h, w, 4)
+        index = self.index[:h, :w]
+        scratch = self.scratch[:h, :w]
+        table_bytes = self.table_bytes[:h, :w]
+        bit_shifts = self.bit_shifts[:h, :w]
+
+        if dst is None or dst.shape != (h, w):
+            self.pool.count_allocation()
+            dst = np.empty((h, w), dtype=np.uint8)
+
+        # Pack each pixel into a 24 bit color index: viewed as a little-endian uint32, BGRA is b | g << 8 | r << 16 | a << 24
+        cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst=bgra_frame)
+        np.bitwise_and(bgra_frame.view(np.uint32)[..., 0], 0xFFFFFF, out=index)
+
+        # Byte index >> 3 holds the result for this color in bit index & 7
+        np.right_shift(index, 3, out=scratch)
+        np.take(self.table, scratch, out=table_bytes, mode='clip')  # indices are always in range, clip skips buffering
+        np.bitwise_and(index, 7, out=scratch)
+        np.copyto(bit_shifts, scratch, casting='unsafe')
+
+        np.right_shift(table_bytes, bit_shifts, out=table_bytes)
+        np.bitwise_and(table_bytes, 1, out=table_bytes)
+        np.multiply(table_bytes, 255, out=dst)
+
+        return dst
+
+
+# Compiled tables are shared between thresholds with the same ranges (ie. several pipelines or detectors)
+threshold_tables = {}
+threshold_tables_lock = threading.Lock()
+
+
+def get_threshold_table(ranges):
+    key = tuple((tuple(int(v) for v in lower), tuple(int(v) for v in upper)) for lower, upper in ranges)
+
+    with threshold_tables_lock:
+        if key not in threshold_tables:
+            threshold_tables[key] = compile_threshold_table(ranges)
+
+        return threshold_tables[key]
+
+
+def compile_threshold_table(ranges):
+    '''
+    Returns the 2 MB bit-packed table of which BGR colors are in any of the HSV ranges. The bit for color (b, g, r)
+    is bit (i & 7) of byte (i >> 3), where i = b | g << 8 | r << 16.
+    '''
+    # Every (b, g) combination for a single red value, as a 256x256 image: rows are g, columns are b
+    colors = np.empty((256, 256, 3), dtype=np.uint8)
+    colors[..., 0] = np.arange(256, dtype=np.uint8)[np.newaxis, :]
+    colors[..., 1] = np.arange(256, dtype=np.uint8)[:, np.newaxis]
+
+    mask = np.empty((256, 256 * 256), dtype=bool)
+    threshold = HSVThreshold(ranges)
+
+    for r in range(256):
+        colors[..., 2] = r
+        mask[r] = threshold.apply(colors).reshape(-1) != 0
+
+    return np.packbits(mask.reshape(-1), bitorder='little')
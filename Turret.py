@@ -1,13 +1,31 @@
 import cv2
+import functools
 import numpy as np
 import math
 import Utility
 import traceback
 import logging
+import weakref
+from Threshold import HSVThreshold
+from PixelTable import PixelTable
+from StagedPipeline import FrameContext
+from Snapshot import FrameSnapshot, SnapshotBuffer
+from BufferPool import BufferPool
 
 class Turret:
 
-    def __init__(self):
+    def __init__(self, use_lut=False, tracking=False, pyramid_scale=None):
+        '''
+        use_lut (bool): True to threshold with a precompiled BGR lookup table instead of cvtColor + inRange
+            (see HSVThreshold)
+
+        tracking (bool): True to only search a padded window around the last detected target instead of the whole
+            frame (see get_search_window)
+
+        pyramid_scale (float): e.g. 0.25 to find candidate tapes on a frame downscaled by this factor first, and then only
+            threshold the full resolution patches around them (see get_search_regions). None to threshold everything at
+            full resolution.
+        '''
 
         # Calibration camera matrices for the TURRET camera (error = 0.05089120586524974)
         # [[fx, 0, cx]
@@ -23,219 +41,349 @@ class Turret:
                                         [0., 674.16143799, 199.02914604],
                                         [0., 0., 1.]])
 
+        # Angle and distance to the target at every pixel, built from the calibration on the first frame
+        self.angle_table = PixelTable(self.build_angle_table)
+
+        # Every frame-sized array is allocated once and reused (see BufferPool)
+        self.pool = BufferPool('turret')
+
         # Vision constants
         self.hsv_lower = np.array([36, 99, 80])  # 62]) 62 for the captured testing images, 80 for field hsv filter
         self.hsv_upper = np.array([97, 255, 255])
+        self.threshold = HSVThreshold([(self.hsv_lower, self.hsv_upper)], use_lut, self.pool)
+
+        # Tape filters (see get_valid_blobs)
+        self.max_candidates = 10  # only the largest blobs are considered
+        self.min_area = 20  # TODO test and check what min and max area should be +- 10%
+        self.min_fullness = 0.5  # fraction of the bounding rectangle the blob has to fill
+        self.aspect_ratio_range = (1.5, 4.5)  # h / w, ideally greater than 1.5, less than 2.5
+        self.width_range = (0.005, 0.03)  # fraction of the frame width
+        self.height_range = (0.03, 0.15)  # fraction of the frame height
+
+        # Tracking window (see get_search_window)
+        self.tracking = tracking
+        self.track_padding = 32  # min pixels added around the last target on each side
+        self.track_growth = 1.5  # the padding grows by this factor for every frame the target is missed
+        self.max_track_misses = 5  # go back to searching the whole frame after this many misses in a row
+        self.track_box = None  # (x0, y0, x1, y1) around the tapes found last, None if not tracking anything
+        self.track_misses = 0
+
+        # Coarse-to-fine detection (see get_search_regions)
+        self.pyramid_scale = pyramid_scale
+        self.coarse_threshold = HSVThreshold([(self.hsv_lower, self.hsv_upper)], use_lut, self.pool)
 
         self.cam_center = None
 
-        # Pre-allocated frames/arrays
-        self.blur_frame = None
-        self.hsv_frame = None
-        self.mask = None
+        # Pre-allocated frames/arrays (grown to the largest search window, and sliced down to each one). The masks come
+        # from the pool, since they are published with the snapshots.
+        self.coarse_frame = None
+        self.coarse_mask = None
+        self.coarse_labels = None
 
-        self.masked_output = None
-        self.output_frame = None
+        # Data: the values and output frames of the last frame, published together (see FrameSnapshot)
+        self.snapshots = SnapshotBuffer(FrameSnapshot(0, (False, 0, 0), [('mask', None), ('final', None)]))
 
-        # Data
-        self.output_data = (False, 0, 0)
-
-    # Returned frame must be same size as input frame. Draw on the given frame.
+    # The frame isn't drawn on, the annotated output frame is a copy rendered when it's streamed (see render)
     def process(self, frame):
-        temp_output_data = (False, 0, 0)
-
+        # Run every stage in order (StagedPipeline runs them on separate threads instead)
+        ctx = FrameContext(frame)
+        for stage in self.get_stages():
+            ctx.run(stage)
+
+    def get_stages(self):
+        '''
+        Returns the stages of process() in order. Each one takes the FrameContext of a frame and only passes results on
+        through it, so different frames can be in different stages at the same time (see StagedPipeline).
+        '''
+        return [self.threshold_stage, self.contour_stage, self.output_stage, self.publish_stage]
+
+    def threshold_stage(self, ctx):
         # Blur
-        # self.blur_frame = cv2.blur(frame, (4, 4))
-        self.blur_frame = frame
+        # ctx.blur_frame = cv2.blur(ctx.frame, (4, 4))
+        ctx.blur_frame = ctx.frame
 
-        # Filter using HSV mask
-        self.hsv_frame = cv2.cvtColor(self.blur_frame, cv2.COLOR_BGR2HSV)
-        self.mask = cv2.inRange(self.hsv_frame, self.hsv_lower, self.hsv_upper)
+        # Only look at the parts of the frame where the target can be (the whole frame if not tracking or pyramid)
+        ctx.window = self.get_search_window(ctx.frame.shape)
+        regions = self.get_search_regions(ctx.blur_frame, ctx.window)
+
+        # Filter using HSV mask (a new mask every frame, since the later stages still use the last one)
+        ctx.mask = self.threshold_regions(ctx.blur_frame, regions)
 
         # Erode and dilate mask to remove tiny noise
         # Sometimes comment it out. Erode and dilate may cause tape blobs disappear and/or become two large --> ie they
         # become 1 contour instead of 4 distinct contours.
-        # self.mask = cv2.erode(self.mask, None, iterations=1)
-        # self.mask = cv2.dilate(self.mask, None, iterations=3)
-
-        # self.mask = cv2.resize(self.mask, (0, 0), fx=0.25, fy=0.25)
-        self.masked_output = np.copy(self.mask)
+        # ctx.mask = cv2.erode(ctx.mask, None, iterations=1)
+        # ctx.mask = cv2.dilate(ctx.mask, None, iterations=3)
 
-        # Get coordinates of the center of the frame
-        if self.cam_center is None:
-            h, w, _ = frame.shape
-            cam_x = int((w / 2) - 0.5)
-            cam_y = int((h / 2) - 0.5)
-            self.cam_center = (cam_x, cam_y)
+    def contour_stage(self, ctx):
+        x0, y0, x1, y1 = ctx.window
 
-        # Draw reference lines (center line) --> must do after masking otherwise the white line is included
-        h, w, _ = frame.shape
-        cam_x = int((w / 2) - 0.5)
-        cam_y = int((h / 2) - 0.5)
-        cv2.line(frame, (0, cam_y), (w, cam_y),
-                 (255, 255, 255), 2)
-
-
-        # Grab contours
-        contours = cv2.findContours(self.mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Grab contours (only inside the search window, but in full frame coordinates)
+        contours = cv2.findContours(ctx.mask[y0:y1, x0:x1], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                    offset=(x0, y0))
         contours = grab_contours(contours)
 
-        # Process contours
-        output = []
-
-        if len(contours) != 0:
-            # Calculate center of each contour
-            for c in contours:
-                m = cv2.moments(c)
-                if m["m00"] != 0:
-
-                    cx = int(m["m10"] / m["m00"])
-                    cy = int(m["m01"] / m["m00"])
-                    center = [cx, cy]
-
-                    # Append acceptable contours to list
-                    output.append([c, cx, cy, center, cv2.contourArea(c)])
+        # Area, bounding box, centroid, fullness and aspect ratio of every contour at once
+        blobs = get_blob_stats(contours)
+        ctx.trunc_output = blobs[:0]
+        ctx.filtered_output = blobs[:0]
+        ctx.target_blobs = blobs[:0]  # the tapes final_contour_pos is calculated from
+        ctx.final_contour_pos = None
+        ctx.target_pos = None
 
+        if len(blobs) != 0:
             # CONTOUR VALIDATION
-            # Sort by area (descending)
-            output.sort(key=lambda a: a[4], reverse=True)
-            # print(len(output))
+            # Sort by area (descending) and take the 10 largest blobs
+            ctx.trunc_output = blobs[np.argsort(-blobs['area'], kind='stable')][:self.max_candidates]
 
-            # Take the 10 largest contours
-            trunc_output = output[0:(10 if len(output) > 10 else len(output))]
-            # print(len(trunc_output))
-            filtered_output = []
+            # Filter by: area, fullness, aspect ratio, width and height (stays in descending order by area)
+            filtered_output = ctx.trunc_output[self.get_valid_blobs(ctx.trunc_output, ctx.frame.shape)]
+            ctx.filtered_output = filtered_output
 
-            # Filter by: area, fullness, aspect ratio
-            for o in trunc_output:
-
-                x, y, w, h = cv2.boundingRect(o[0])
-                # Draw bounding rectangles (1st round of filtering)
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 127, 255), 1)  # orange
-
-                # print('x, y, w, h', x, y, w, h)
-                # print(o[4], o[4] / (w * h), h / w)
+            # print('f_o', len(filtered_output))
 
-                # Is it large enough?
-                if o[4] < 20:  # TODO test and check what min and max area should be +- 10%
-                    continue
+            # If we have only one tape
+            if len(filtered_output) == 1:
+                final_contour = filtered_output[0]
 
-                # Does it fill at least 80% of its bounding rectangle?
-                if o[4] < (w * h) * 0.5:
-                    continue
+                # logging.info('area, fullness, aspect ratio, %s, %s, %s', final_contour['area'], final_contour['fill'], final_contour['aspect'])
 
-                # Does it have a good aspect ratio?
-                aspect_ratio = h / w  # Ideally greater than 1.5, less than 2.5
-                if aspect_ratio < 1.5 or aspect_ratio > 4.5:
-                    continue
+                # Contour to analyze (ideally the middle tape)
+                ctx.final_contour_pos = (int(final_contour['cx']), int(final_contour['cy']))
+                ctx.target_pos = (final_contour['cx'], final_contour['cy'])
+                ctx.target_blobs = filtered_output[:1]
 
-                frame_h, frame_w, _ = frame.shape
+            # If we have two tapes to average out (the two largest)
+            if len(filtered_output) > 1:
+                # Calculate the final contour position (average of x and y)
+                cx = np.trunc(filtered_output['cx'][:2])
+                cy = np.trunc(filtered_output['cy'][:2])
+                ctx.final_contour_pos = (int((cx[0] + cx[1]) / 2), int((cy[0] + cy[1]) / 2))
+                ctx.target_pos = (filtered_output['cx'][:2].mean(), filtered_output['cy'][:2].mean())
+                ctx.target_blobs = filtered_output[:2]
 
-                # print('0.01 - 0.02 for w/frame_w', w/frame_w)
-                # print('0.04 to 0.10 for h/frame_h', h/frame_h)
-                # Is the width of the tape too large or too small?
-                # (less than 1% of total width or greater than 2% of total width)?
-                if w > 0.03 * frame_w or w < 0.005 * frame_w:
-                    continue
+        self.update_tracking(ctx.target_blobs)
 
-                if h > 0.15 * frame_h or h < 0.03 * frame_h:
-                    continue
+    def output_stage(self, ctx):
+        ctx.output_data = (False, 0, 0)
 
-                # Else, we've found a good contour!
-                filtered_output.append(o)
+        if ctx.final_contour_pos is not None:
+            h = ctx.frame.shape[0]
 
-                # Draw bounding rectangles (2nd round of filtering)
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 1)  # red
+            # (NOT USED) Use interpolation to calculate distance
+            interp_d = (36.75131166 * (math.e ** (0.002864827 * ctx.final_contour_pos[0]))) + 18.65849
 
-            # print('f_o', len(filtered_output))
+            # (NOT USED) Calculate pixel distance to target
+            pixel_theta = (h / 2.0 + 0.5) - ctx.final_contour_pos[1]
 
-            # no need to sort; it's already in descending order by area
-            # filtered_output.sort(key=lambda a: a[4], reverse=True)
-            final_contour = None
-            if len(filtered_output) > 0:
+            # Use FOV to calculate turret angle to target (radians) and distance (at the sub-pixel centroid)
+            fov_ax, fov_ay, fov_d = self.get_ball_values(ctx.frame, ctx.target_pos)
 
-                # filtered_output.sort(key=lambda a: frame[a[1], a[2]][1], reverse=True)  # sort by saturavation value of center pixel, descending
-                final_contour = filtered_output[0]
+            # Vision data to pass
+            turret_vision_status = True
+            turret_theta = fov_ay  # return angle to target obtained from FOV (camera is rotated, see get_ball_values)
+            hub_distance = fov_d  # pass distance obtained from FOV lol cuz it seems p accurate
 
-            # Store the second tape if detected
-            if len(filtered_output) > 1:
-                final_contour_2 = filtered_output[1]
-            else:
-                final_contour_2 = None
+            ctx.output_data = (turret_vision_status, turret_theta, hub_distance)
 
-            final_contour_pos = None
+            # ax, d = self.get_ball_values_calib(frame, largest_cnt_pos)
 
-            # If we have only one tape
-            if (final_contour is not None) and (final_contour_2 is None):
-                # Draw the bounding box
-                x, y, w, h = cv2.boundingRect(final_contour[0])
-                cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 0, 0), 2)
+    def publish_stage(self, ctx):
+        # Set output data and frames at once. The mask is this frame's own, so it doesn't need to be copied. The
+        # annotated frame is only drawn if someone watches the stream.
+        final = functools.partial(self.render, ctx)
+        snapshot = FrameSnapshot(ctx.frame_seq, ctx.output_data, [('mask', ctx.mask), ('final', final)],
+                                 ctx.capture_time)
 
-                # print('x, y, w, h', x, y, w, h)
-                # logging.info('area, fullness, aspect ratio, %s, %s, %s', final_contour[4], final_contour[4] / (w * h), h / w)
+        # The mask can be thresholded into again once nobody holds its snapshot or its read-only view anymore (a stream
+        # client may still be encoding it long after the snapshot left the SnapshotBuffer)
+        weakref.finalize(snapshot.get_frame('mask'), self.pool.release, ctx.mask)
+        self.snapshots.publish(snapshot)
 
-                # Draw contour to analyze in blue (ideally the middle tape)
-                final_contour_pos = (final_contour[1], final_contour[2])
+        self.pool.end_frame()
 
-            # If we have two tapes to average out
-            if (final_contour is not None) and (final_contour_2 is not None):
-                # Find the two bounding boxes and draw them
-                x1, y1, w1, h1 = cv2.boundingRect(final_contour[0])
-                x2, y2, w2, h2 = cv2.boundingRect(final_contour_2[0])
+    def drop_frame(self, ctx):
+        '''Gives the mask of a frame that won't be published back to the pool (see StagedPipeline)'''
+        self.pool.release(getattr(ctx, 'mask', None))
+        ctx.mask = None
 
-                cv2.rectangle(frame, (x1, y1), (x1 + w1, y1 + h1), (255, 0, 0), 2)
-                cv2.rectangle(frame, (x2, y2), (x2 + w2, y2 + h2), (255, 0, 0), 2)
+    def render(self, ctx):
+        '''Returns a copy of the frame with the search window, candidate tapes and target drawn on (for the stream)'''
+        frame = np.copy(ctx.frame)
+        x0, y0, x1, y1 = ctx.window
 
-                # Calculate the final contour position (average of x and y)
-                final_contour_pos = (int((final_contour[1] + final_contour_2[1]) / 2), int((final_contour[2] + final_contour_2[2]) / 2))
+        # ctx.mask = cv2.resize(ctx.mask, (0, 0), fx=0.25, fy=0.25)
 
-            if final_contour_pos is not None:
-                cv2.circle(frame, final_contour_pos, 5, (255, 0, 0), 10)  # Blue
+        # Get coordinates of the center of the frame
+        if self.cam_center is None:
+            h, w, _ = frame.shape
+            cam_x = int((w / 2) - 0.5)
+            cam_y = int((h / 2) - 0.5)
+            self.cam_center = (cam_x, cam_y)
 
-                # (NOT USED) Use interpolation to calculate distance
-                interp_d = (36.75131166 * (math.e ** (0.002864827 * final_contour_pos[0]))) + 18.65849
+        # Draw reference lines (center line), on the copy so the mask and contours never see it
+        h, w, _ = frame.shape
+        cam_x = int((w / 2) - 0.5)
+        cam_y = int((h / 2) - 0.5)
+        cv2.line(frame, (0, cam_y), (w, cam_y),
+                 (255, 255, 255), 2)
 
-                # (NOT USED) Calculate pixel distance to target
-                pixel_theta = (h / 2.0 + 0.5) - final_contour_pos[1]
+        if (x1 - x0, y1 - y0) != (w, h):
+            cv2.rectangle(frame, (x0, y0), (x1 - 1, y1 - 1), (127, 127, 127), 1)  # gray
 
-                # Use FOV to calculate turret angle to target (radians) and distance
-                fov_ax, fov_d = self.get_ball_values(frame, final_contour_pos)
+        # Draw bounding rectangles (1st round of filtering)
+        for b in ctx.trunc_output:
+            draw_blob(frame, b, (0, 127, 255), 1)  # orange
 
-                # Vision data to pass
-                h, w, _ = frame.shape
-                turret_vision_status = True
-                turret_theta = fov_ax  # return angle to target obtained from FOV
-                hub_distance = fov_d  # pass distance obtained from FOV lol cuz it seems p accurate
+        # Draw bounding rectangles (2nd round of filtering)
+        for b in ctx.filtered_output:
+            draw_blob(frame, b, (0, 0, 255), 1)  # red
 
-                temp_output_data = (turret_vision_status, turret_theta, hub_distance)
+        # Draw the tapes the target was found from and the target in blue
+        for b in ctx.target_blobs:
+            draw_blob(frame, b, (255, 0, 0), 2)
 
-                # ax, d = self.get_ball_values_calib(frame, largest_cnt_pos)
+        if ctx.final_contour_pos is not None:
+            cv2.circle(frame, ctx.final_contour_pos, 5, (255, 0, 0), 10)  # Blue
 
-        # Copy to the output frame
         # frame = cv2.resize(frame, (0, 0), fx=0.5, fy=0.5)
-        self.output_frame = np.copy(frame)
 
-        # Set output data
-        self.output_data = temp_output_data
+        return frame
+
+    def get_valid_blobs(self, blobs, frame_shape):
+        '''Returns a boolean mask of the blobs (from get_blob_stats) that pass every tape filter'''
+        frame_h, frame_w = frame_shape[:2]
+
+        # Is it large enough?
+        valid = blobs['area'] >= self.min_area
+
+        # Does it fill at least half of its bounding rectangle?
+        valid &= blobs['fill'] >= self.min_fullness
+
+        # Does it have a good aspect ratio?
+        valid &= (blobs['aspect'] >= self.aspect_ratio_range[0]) & (blobs['aspect'] <= self.aspect_ratio_range[1])
+
+        # print('0.01 - 0.02 for w/frame_w', w/frame_w)
+        # print('0.04 to 0.10 for h/frame_h', h/frame_h)
+        # Is the width or height of the tape too large or too small?
+        valid &= (blobs['w'] <= self.width_range[1] * frame_w) & (blobs['w'] >= self.width_range[0] * frame_w)
+        valid &= (blobs['h'] <= self.height_range[1] * frame_h) & (blobs['h'] >= self.height_range[0] * frame_h)
+
+        return valid
+
+    def get_search_window(self, frame_shape):
+        '''
+        Returns the (x0, y0, x1, y1) part of the frame to search for tape. When tracking, this is the box around the tapes
+        found last, padded by at least track_padding (or the box size), and the padding grows on every miss.
+        Otherwise it's the whole frame.
+        '''
+        frame_h, frame_w = frame_shape[:2]
+
+        if not self.tracking or self.track_box is None:
+            return 0, 0, frame_w, frame_h
+
+        x0, y0, x1, y1 = self.track_box
+        growth = self.track_growth ** self.track_misses
+        pad_x = int(max(self.track_padding, x1 - x0) * growth)
+        pad_y = int(max(self.track_padding, y1 - y0) * growth)
+
+        return max(x0 - pad_x, 0), max(y0 - pad_y, 0), min(x1 + pad_x, frame_w), min(y1 + pad_y, frame_h)
+
+    def get_search_regions(self, frame, window):
+        '''
+        Returns the list of (x0, y0, x1, y1) regions inside the search window to threshold at full resolution.
+        Without pyramid_scale, this is just the window. Otherwise the window is downscaled and thresholded first, and only
+        patches around the largest coarse blobs are returned, padded so that the full resolution tape fits in them.
+        '''
+        if self.pyramid_scale is None:
+            return [window]
+
+        x0, y0, x1, y1 = window
+
+        # Same size cv2.resize picks for fx and fy (rounded half to even like cvRound)
+        coarse_w = round((x1 - x0) * self.pyramid_scale)
+        coarse_h = round((y1 - y0) * self.pyramid_scale)
+        self.coarse_frame = self.pool.fit(self.coarse_frame, (coarse_h, coarse_w, 3))
+        self.coarse_mask = self.pool.fit(self.coarse_mask, (coarse_h, coarse_w))
+        self.coarse_labels = self.pool.fit(self.coarse_labels, (coarse_h, coarse_w), np.int32)
+
+        coarse_frame = self.coarse_frame[:coarse_h, :coarse_w]
+        coarse_frame = self.pool.reuse(cv2.resize(frame[y0:y1, x0:x1], (0, 0), dst=coarse_frame, fx=self.pyramid_scale,
+                                                  fy=self.pyramid_scale, interpolation=cv2.INTER_AREA), coarse_frame)
+        coarse_mask = self.coarse_threshold.apply(coarse_frame, self.coarse_mask[:coarse_h, :coarse_w])
+
+        # Coarse tapes can be only a pixel wide, so use connected components (which keeps those) instead of contours
+        num_labels, _, stats, _ = cv2.connectedComponentsWithStats(coarse_mask, self.coarse_labels[:coarse_h, :coarse_w],
+                                                                   connectivity=8)
+        stats = stats[1:]  # label 0 is the background
+
+        # Only refine the largest blobs
+        stats = stats[np.argsort(-stats[:, cv2.CC_STAT_AREA], kind='stable')][:self.max_candidates]
+
+        # Back to full resolution, with a coarse pixel of padding for the tape edges that got averaged away
+        pad = int(math.ceil(1 / self.pyramid_scale))
+        regions = []
+        for left, top, width, height, _ in stats:
+            regions.append((max(x0 + int(left / self.pyramid_scale) - pad, x0),
+                            max(y0 + int(top / self.pyramid_scale) - pad, y0),
+                            min(x0 + int((left + width) / self.pyramid_scale) + pad, x1),
+                            min(y0 + int((top + height) / self.pyramid_scale) + pad, y1)))
+
+        return regions
+
+    def threshold_regions(self, frame, regions):
+        '''
+        Returns a mask (from the pool) of the (x0, y0, x1, y1) regions of the frame thresholded. The rest of the mask is 0.
+        '''
+        frame_h, frame_w = frame.shape[:2]
+        mask = self.pool.acquire((frame_h, frame_w))
+
+        if regions == [(0, 0, frame_w, frame_h)]:
+            return self.threshold.apply(frame, mask)
+
+        mask.fill(0)
+
+        # Threshold straight into the mask (overlapping regions just threshold the same pixels again)
+        for x0, y0, x1, y1 in regions:
+            self.threshold.apply(frame[y0:y1, x0:x1], mask[y0:y1, x0:x1])
+
+        return mask
+
+    def update_tracking(self, target_blobs):
+        '''Updates the tracking window with the tapes the target was found from (empty if the target was missed)'''
+        if len(target_blobs) != 0:
+            self.track_box = (int(target_blobs['x'].min()), int(target_blobs['y'].min()),
+                              int((target_blobs['x'] + target_blobs['w']).max()),
+                              int((target_blobs['y'] + target_blobs['h']).max()))
+            self.track_misses = 0
+
+        elif self.track_box is not None:
+            self.track_misses += 1
+
+            # Lost it, search the whole frame again
+            if self.track_misses > self.max_track_misses:
+                self.track_box = None
+                self.track_misses = 0
 
     def get_output_values(self):
-        return self.output_data
+        return self.snapshots.latest().get_output_values()
 
     def get_output_frames(self):
-        return [
-            {
-                'name': 'mask',
-                'frame': self.masked_output
-            },
-            {
-                'name': 'final',
-                'frame': self.output_frame
-            }
-        ]
+        return self.snapshots.latest().get_output_frames()
+
+    # Values and output frames of the same frame, see FrameSnapshot
+    def get_snapshot(self):
+        return self.snapshots.latest()
+
+    # Frame-sized allocations per frame, should be 0 once running (see BufferPool)
+    def get_allocations_per_frame(self):
+        return self.pool.get_allocations_per_frame()
 
     def set_hsv(self, new_lower, new_upper):
         self.hsv_lower = new_lower
         self.hsv_upper = new_upper
+        self.threshold.set_ranges([(self.hsv_lower, self.hsv_upper)])
+        self.coarse_threshold.set_ranges([(self.hsv_lower, self.hsv_upper)])
 
     def get_ball_values_from_tvec(self, tvec):
         """ Ideally returns a distanc and pitch angle to target (ie. angle that the turret needs to rotate) but more
@@ -253,6 +401,30 @@ class Turret:
 
     def get_ball_values(self, frame, center):
         '''Calculate the angle and distance from the camera to the center point of the robot
+        Looks the (sub-pixel) center up in the angle table, see build_angle_table'''
+        ax, ay, d = self.angle_table.lookup(frame.shape, center[0], center[1])
+
+        # return horizontal and vertical angle of the camera image, and distance. The camera is rotated 90, so the
+        # vertical image angle is the turret's horizontal angle to the target
+        return float(ax), float(ay), float(d)
+
+    def build_angle_table(self, shape):
+        '''Returns the (h, w, 3) table of get_fov_values (ax, ay, d) of every undistorted pixel of a frame this shape'''
+        h, w = shape[:2]
+
+        # Undistort every pixel coordinate at once
+        xs, ys = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        ptlist = np.stack((xs, ys), axis=-1).reshape(-1, 1, 2)
+        out_pts = cv2.undistortPoints(ptlist, self.camera_mtx, self.distortion, P=self.camera_mtx)
+
+        tx = out_pts[:, 0, 0].astype(np.float64)
+        ty = out_pts[:, 0, 1].astype(np.float64)
+        ax, ay, d = self.get_fov_values(tx, ty, shape)
+
+        return np.stack((ax, ay, d), axis=-1).reshape(h, w, 3).astype(np.float32)
+
+    def get_fov_values(self, tx, ty, shape):
+        '''Calculate the angle and distance from the camera to undistorted pixel coordinates (scalars or arrays)
         This routine uses the FOV numbers and the default center to convert to normalized coordinates'''
 
         HFOV = math.radians(57.15)  # horizontal angle of the field of view
@@ -263,16 +435,6 @@ class Turret:
         VP_HALF_WIDTH = math.tan(HFOV / 2.0)  # view plane 1/2 height
         VP_HALF_HEIGHT = math.tan(VFOV / 2.0)  # view plane 1/2 width
 
-        shape = frame.shape
-
-        # target x and y pixel coordinates
-        tx = center[0]
-        ty = center[1]
-
-        undist_center = self.undistort_points(center)
-        tx = undist_center[0]
-        ty = undist_center[1]
-
         # center is in pixel coordinates, 0,0 is the upper-left, positive down and to the right
         # (nx,ny) = normalized pixel coordinates, 0,0 is the center, positive right and up
         # WARNING: shape is (h, w, nbytes) not (w,h,...)
@@ -280,31 +442,28 @@ class Turret:
         image_h = shape[0] / 2.0
 
         # NOTE: the 0.5 is to place the location in the center of the pixel
-        # print("center", center, "shape", shape)
         nx = (tx - image_w + 0.5) / image_w
         ny = (image_h - 0.5 - ty) / image_h
 
         # convert normal pixel coords to pixel coords
         x = VP_HALF_WIDTH * nx
         y = VP_HALF_HEIGHT * ny
-        # print("values", tx, ty, nx, ny, x, y)
 
         # now have all pieces to convert to angle:
-        ax = -math.atan2(x, 1.0)     # horizontal angle
+        ax = -np.arctan2(x, 1.0)     # horizontal angle
 
         # naive expression
-        # ay = math.atan2(y, 1.0)     # vertical angle
+        # ay = np.arctan2(y, 1.0)     # vertical angle
 
         # corrected expression.
         # As horizontal angle gets larger, real vertical angle gets a little smaller
-        ay = math.atan2(y * math.cos(ax), 1.0)     # vertical angle
-        # print("ax, ay", math.degrees(ax), math.degrees(ay))
+        ay = np.arctan2(y * np.cos(ax), 1.0)     # vertical angle
 
         target_height = 99
         camera_height = 27
         tilt_angle = math.radians(50)
         # now use the x and y angles to calculate the distance to the target:
-        d = (target_height - camera_height) / math.tan(tilt_angle + ax)    # distance to the target
+        d = (target_height - camera_height) / np.tan(tilt_angle + ax)    # distance to the target
         # add radius of hub
         hub_diameter = 4 * 12 + 5 + 3/8.0  # 4 feet, 5 3/8 inches
         d += hub_diameter / 2.0
@@ -312,7 +471,12 @@ class Turret:
         d *= 100 / 80.0
         # logging.info('using fov, ax, ay, d, %f, %f, %f', math.degrees(ax), math.degrees(ay), d)
 
-        return ay, d    # return horizontal angle to target and distance
+        return ax, ay, d
+
+    def set_calibration(self, camera_mtx, distortion):
+        self.camera_mtx = camera_mtx
+        self.distortion = distortion
+        self.angle_table.invalidate()
 
     def undistort_points(self, center):
         # use the distortion and camera arrays to correct the location of the center point
@@ -326,6 +490,78 @@ class Turret:
         return undist_center
 
 
+# Features of each blob returned by get_blob_stats, one row per blob
+BLOB_DTYPE = np.dtype([
+    ('area', np.float64),  # same as cv2.contourArea
+    ('x', np.int32),  # bounding box, same as cv2.boundingRect
+    ('y', np.int32),
+    ('w', np.int32),
+    ('h', np.int32),
+    ('cx', np.float64),  # centroid, same as m10 / m00 from cv2.moments
+    ('cy', np.float64),
+    ('fill', np.float64),  # area / bounding box area
+    ('aspect', np.float64),  # h / w
+])
+
+
+def get_blob_stats(contours):
+    '''
+    Computes the features of every contour at once and returns them as a structured array of BLOB_DTYPE.
+    Rather than calling cv2.moments, cv2.contourArea and cv2.boundingRect per contour, all contour points are
+    concatenated and the polygon moments (shoelace formula) and bounds are reduced per contour with NumPy.
+    Contours with zero area are dropped since they have no centroid.
+    '''
+    if len(contours) == 0:
+        return np.empty(0, dtype=BLOB_DTYPE)
+
+    lengths = np.fromiter((len(c) for c in contours), dtype=np.intp, count=len(contours))
+    starts = np.zeros(len(contours), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+
+    points = np.concatenate(contours).reshape(-1, 2)
+    x = points[:, 0].astype(np.float64)
+    y = points[:, 1].astype(np.float64)
+
+    # Index of the next point along each (closed) contour
+    next_idx = np.arange(1, len(points) + 1)
+    next_idx[starts + lengths - 1] = starts
+    x_next = x[next_idx]
+    y_next = y[next_idx]
+
+    # Polygon moments
+    cross = x * y_next - x_next * y
+    m00 = np.add.reduceat(cross, starts) / 2.0
+    m10 = np.add.reduceat((x + x_next) * cross, starts) / 6.0
+    m01 = np.add.reduceat((y + y_next) * cross, starts) / 6.0
+
+    # Bounding boxes
+    x_min = np.minimum.reduceat(points[:, 0], starts)
+    y_min = np.minimum.reduceat(points[:, 1], starts)
+    x_max = np.maximum.reduceat(points[:, 0], starts)
+    y_max = np.maximum.reduceat(points[:, 1], starts)
+
+    valid = m00 != 0
+
+    blobs = np.empty(np.count_nonzero(valid), dtype=BLOB_DTYPE)
+    blobs['area'] = np.abs(m00[valid])
+    blobs['x'] = x_min[valid]
+    blobs['y'] = y_min[valid]
+    blobs['w'] = x_max[valid] - x_min[valid] + 1
+    blobs['h'] = y_max[valid] - y_min[valid] + 1
+    blobs['cx'] = m10[valid] / m00[valid]
+    blobs['cy'] = m01[valid] / m00[valid]
+    blobs['fill'] = blobs['area'] / (blobs['w'] * blobs['h'])
+    blobs['aspect'] = blobs['h'] / blobs['w']
+
+    return blobs
+
+
+def draw_blob(frame, blob, color, thickness):
+    # Draw the bounding rectangle of a single blob from get_blob_stats
+    x, y, w, h = int(blob['x']), int(blob['y']), int(blob['w']), int(blob['h'])
+    cv2.rectangle(frame, (x, y), (x + w, y + h), color, thickness)
+
+
 # Pulled from imutils package definition
 def grab_contours(cnts):
     # if the length the contours tuple returned by cv2.findContours
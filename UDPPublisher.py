@@ -0,0 +1,80 @@
+import socket
+import threading
+import logging
+
+
+class UDPPublisher:
+    '''
+    Sends every new vision result as one UDP datagram to each subscriber (ie. the robot, the driver station and a
+    logger). Nothing is retransmitted and nothing waits on a slow or missing receiver: a lost packet is simply replaced
+    by the next result. Receivers should keep the message with the highest msg_seq and drop older or reordered ones
+    (see scripts/udp_client.py).
+    '''
+
+    def __init__(self, wait_for_message, subscribers=(), name='telemetry'):
+        '''
+        wait_for_message -- function(after_seq, timeout) that returns (seq, message bytes) of the next result, or
+            (after_seq, None) on timeout (ie. Main.wait_for_message)
+        subscribers -- list of (host, port) to send to
+        '''
+        self.wait_for_message = wait_for_message
+        self.name = name
+
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        for address in subscribers:
+            self.add_subscriber(address)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        self.running = False
+        self.thread = None
+
+    def add_subscriber(self, address):
+        host, port = address
+        with self.subscribers_lock:
+            if (host, port) not in self.subscribers:
+                self.subscribers.append((host, port))
+
+    def remove_subscriber(self, address):
+        with self.subscribers_lock:
+            if tuple(address) in self.subscribers:
+                self.subscribers.remove(tuple(address))
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name=self.name + '-udp', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sock.close()
+
+    # Used in thread
+    def run(self):
+        logging.info('Sending vision data over UDP to %s', self.subscribers)
+        seq = 0
+
+        while self.running:
+            seq, message = self.wait_for_message(seq, timeout=0.5)
+            if message is None:
+                continue
+
+            self.send(message)
+
+    def send(self, message):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+
+        for address in subscribers:
+            try:
+                self.sock.sendto(message, address)
+            except (BlockingIOError, InterruptedError):
+                pass  # send buffer full, the next result replaces this one anyway
+            except OSError as e:
+                # ie. the subscriber isn't up yet (ICMP port unreachable) or its address can't be resolved
+                logging.debug('Could not send vision data to %s: %s', address, e)
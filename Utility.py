@@ -1,4 +1,5 @@
 import cv2
+import math
 
 '''
 Frame is the image.
@@ -21,3 +22,76 @@ def put_text_group(frame, text):
         cv2.putText(frame, t, (text_x, text_y), font, font_scale, font_color, font_thickness)
         text_y += text_delta_y
 
+
+
+'''
+Gaussian blur with standard deviation sigma (and kernel size ksize for the exact blur).
+Mode picks how it's computed:
+    'gaussian' -- exact cv2.GaussianBlur. Cost grows with the kernel size.
+    'box' -- cascade of 3 box filters whose widths approximate the gaussian (within a few levels). Cost doesn't depend
+        on sigma.
+    'pyramid' -- downsample by 4, blur with sigma / 4, then upsample. Cheapest, but less accurate around edges.
+        The small frame is downsampled and blurred into small (of get_pyramid_shape(frame.shape)), allocated every
+        call if None.
+'''
+def blur(frame, sigma, ksize, mode='gaussian', dst=None, small=None):
+    if mode == 'gaussian':
+        return cv2.GaussianBlur(frame, (ksize, ksize), sigma, dst=dst)
+
+    if mode == 'box':
+        box_sizes = get_box_sizes(sigma)
+        dst = cv2.blur(frame, box_sizes[0], dst=dst)
+        for box_size in box_sizes[1:]:
+            cv2.blur(dst, box_size, dst=dst)
+        return dst
+
+    if mode == 'pyramid':
+        h, w = frame.shape[:2]
+        small_h, small_w = get_pyramid_shape(frame.shape)[:2]
+        small = cv2.resize(frame, (small_w, small_h), dst=small, interpolation=cv2.INTER_AREA)
+        cv2.GaussianBlur(small, (0, 0), sigma / 4.0, dst=small)
+        return cv2.resize(small, (w, h), dst=dst, interpolation=cv2.INTER_LINEAR)
+
+    raise ValueError('Unknown blur mode: ' + str(mode))
+
+
+'''
+Returns the shape of the downsampled frame of blur(mode='pyramid') for a frame of this shape.
+'''
+def get_pyramid_shape(shape):
+    return (max(1, round(shape[0] * 0.25)), max(1, round(shape[1] * 0.25))) + tuple(shape[2:])
+
+
+'''
+Returns the (w, w) sizes of 3 box filters that, applied one after the other, approximate a gaussian with standard
+deviation sigma. See "Fast Almost-Gaussian Filtering" (Kovesi 2010).
+'''
+def get_box_sizes(sigma, n=3):
+    # Ideal width of n equal boxes, rounded down to the nearest odd size
+    w_ideal = math.sqrt((12 * sigma * sigma / n) + 1)
+    w_lower = int(math.floor(w_ideal))
+    if w_lower % 2 == 0:
+        w_lower -= 1
+    w_upper = w_lower + 2
+
+    # How many of the boxes use the smaller width
+    m = round((12 * sigma * sigma - n * w_lower * w_lower - 4 * n * w_lower - 3 * n) / (-4 * w_lower - 4))
+
+    return [(w_lower, w_lower) if i < m else (w_upper, w_upper) for i in range(n)]
+
+
+'''
+Asks a VideoCapture for the camera's own MJPEG frames without decoding them (V4L only, ie. the LifeCam's MJPG modes in
+GenericHTTPServer.py), so read() returns the JPEG bytes as a single row of uint8. Returns False if the backend can't.
+Frames that come back decoded anyway are still fine, see is_jpeg().
+'''
+def request_mjpeg(cap):
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    return cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+
+'''
+True if a frame read from a VideoCapture (see request_mjpeg) is still the camera's JPEG instead of a decoded image.
+'''
+def is_jpeg(frame):
+    return frame is not None and frame.dtype == 'uint8' and (frame.ndim == 1 or (frame.ndim == 2 and frame.shape[0] == 1))
@@ -0,0 +1,198 @@
+# Offline benchmark of the Turret and Intake pipelines over the bundled images/ and images_2/ datasets, no camera
+# needed. Prints one JSON document (or writes it to --output) so runs before and after a change can be compared.
+#
+# python scripts/benchmark.py
+# python scripts/benchmark.py --resolutions native 320x240 --turret-options '{"use_lut": true}' --output before.json
+
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+# Run from anywhere, the pipelines are one directory up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from Turret import Turret
+from Intake import Intake
+from StagedPipeline import FrameContext
+from LatencyStats import LatencyStats
+
+
+def load_images(pattern):
+    '''Returns a list of (file name, frame) of every image matching pattern, decoded once up front'''
+    images = []
+    for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+        frame = cv2.imread(path)
+        if frame is not None:
+            images.append((os.path.basename(path), frame))
+    return images
+
+
+def parse_distance(file_name):
+    '''Returns the true hub distance (in) encoded in a file name like 106.25_1.0.png or ...6ft10in.png, None if none'''
+    feet_inches = re.search(r'(\d+)ft(\d+)in', file_name)
+    if feet_inches is not None:
+        return int(feet_inches.group(1)) * 12 + int(feet_inches.group(2))
+
+    try:
+        return float(file_name.split('_')[0])
+    except ValueError:
+        return None
+
+
+def resize_images(images, resolution):
+    '''resolution -- 'native', or 'WxH' (ie. '320x240') to resize every frame to'''
+    if resolution == 'native':
+        return images
+
+    w, h = (int(n) for n in resolution.split('x'))
+    return [(name, cv2.resize(frame, (w, h), interpolation=cv2.INTER_AREA)) for name, frame in images]
+
+
+def run_frame(pipeline, frame, latency, name):
+    # Same as pipeline.process(frame), but keeps the FrameContext to time every stage
+    start = time.perf_counter()
+    ctx = FrameContext(frame)
+    for stage in pipeline.get_stages():
+        ctx.run(stage)
+    latency.record(name + '.frame', time.perf_counter() - start)
+    latency.record_stages(name, ctx)
+
+
+def benchmark(name, make_pipeline, images, iterations, warmup):
+    '''
+    Runs a new pipeline over every image iterations times, as fast as it goes. Returns a dict of the FPS, the
+    percentiles of the whole frame and of every stage (ms), the peak traced memory, the frame-sized allocations and the
+    output values of each image.
+    '''
+    pipeline = make_pipeline()
+    latency = LatencyStats(window=iterations * len(images), log_interval=None)
+
+    for _ in range(warmup):
+        for _, frame in images:
+            pipeline.process(frame)
+
+    allocations = pipeline.pool.allocations
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for _, frame in images:
+            run_frame(pipeline, frame, latency, name)
+    elapsed = time.perf_counter() - start
+    allocations = pipeline.pool.allocations - allocations
+
+    # Output values of each image, from a pipeline that hasn't seen the others (tracking keeps state between frames)
+    values = {}
+    for file_name, frame in images:
+        single = make_pipeline()
+        single.process(frame)
+        values[file_name] = list(single.get_output_values())
+
+    # Peak memory allocated during one more pass (traced separately since tracing slows everything down)
+    tracemalloc.start()
+    for _, frame in images:
+        pipeline.process(frame)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    percentiles = latency.get_percentiles()
+    frames = iterations * len(images)
+    return {
+        'frames': frames,
+        'fps': round(frames / elapsed, 2) if elapsed > 0 else None,
+        'frame_ms': percentiles.pop(name + '.frame'),
+        'stage_ms': {stage_name[len(name) + 1:]: p for stage_name, p in percentiles.items()},
+        'peak_traced_mb': round(peak / 1e6, 2),
+        'allocations_per_frame': round(allocations / frames, 3),  # frame-sized ones after the warmup, see BufferPool
+        'values': values,
+    }
+
+
+def turret_accuracy(values):
+    '''Distance error against the file names (the ones that have a distance) of the turret output values'''
+    errors = []
+    missed = []
+    angles = []
+    for file_name, (detected, theta, distance) in values.items():
+        true_distance = parse_distance(file_name)
+        if true_distance is None:
+            continue
+
+        if not detected:
+            missed.append(file_name)
+            continue
+
+        errors.append(distance - true_distance)
+        angles.append(theta)
+
+    errors = np.abs(np.array(errors, dtype=np.float64))
+    return {
+        'labeled': len(errors) + len(missed),
+        'detected': len(errors),
+        'missed': missed,
+        'distance_mean_abs_error': round(float(errors.mean()), 3) if len(errors) else None,
+        'distance_max_abs_error': round(float(errors.max()), 3) if len(errors) else None,
+        # The file names don't encode the angle, so only how far off center the target was is reported
+        'angle_mean_abs': round(float(np.abs(angles).mean()), 4) if angles else None,
+        'angle_max_abs': round(float(np.abs(angles).max()), 4) if angles else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the vision pipelines on the bundled images')
+    parser.add_argument('--iterations', type=int, default=20, help='passes over each dataset')
+    parser.add_argument('--warmup', type=int, default=2, help='passes before timing starts')
+    parser.add_argument('--resolutions', nargs='+', default=['native'],
+                        help="'native' and/or WxH sizes to resize the frames to (ie. native 320x240 160x120)")
+    parser.add_argument('--turret-options', type=json.loads, default={},
+                        help='JSON keyword arguments for Turret (ie. \'{"use_lut": true, "pyramid_scale": 0.25}\')')
+    parser.add_argument('--intake-options', type=json.loads, default={},
+                        help='JSON keyword arguments for Intake (ie. \'{"blur_mode": "box"}\')')
+    parser.add_argument('--pipelines', nargs='+', default=['turret', 'intake'], choices=['turret', 'intake'])
+    parser.add_argument('--output', help='file to write the JSON to instead of stdout')
+    args = parser.parse_args()
+
+    datasets = {
+        'turret': (lambda: Turret(**args.turret_options), load_images('images/*.png')),
+        'intake': (lambda: Intake(**args.intake_options), load_images('images_2/*.png')),
+    }
+
+    results = []
+    for name in args.pipelines:
+        make_pipeline, images = datasets[name]
+        for resolution in args.resolutions:
+            result = benchmark(name, make_pipeline, resize_images(images, resolution), args.iterations, args.warmup)
+            result = dict({'pipeline': name, 'resolution': resolution, 'images': len(images)}, **result)
+            if name == 'turret':
+                result['accuracy'] = turret_accuracy(result['values'])
+            results.append(result)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'args': vars(args),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),  # KB on Linux
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import socket
+import struct
+
+HOST = ''  # Receive on all interfaces
+PORT = 5805  # Port the vision UDPPublisher sends to
+
+# Same layout as MESSAGE in Telemetry.py
+MESSAGE = struct.Struct('!2sBBId' 'Idd?dd' 'Idd?')
+
+with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+    s.bind((HOST, PORT))
+    last_seq = -1
+    while True:
+        data = s.recv(1024)
+        fields = MESSAGE.unpack(data[:MESSAGE.size])
+        msg_seq = fields[3]
+
+        # Latest value wins: drop anything older than what we already have (sequence numbers wrap at 2^32)
+        if last_seq >= 0 and (msg_seq - last_seq) % (1 << 32) >= (1 << 31):
+            print('stale', msg_seq)
+            continue
+        last_seq = msg_seq
+
+        print(msg_seq, fields[8:11], fields[14])